@@ -14,6 +14,7 @@ from scipy.ndimage.filters import gaussian_filter
 from scipy.sparse import csc_matrix
 from scipy.sparse.linalg import inv
 from MotionEST import MotionEST
+from Util import integralImage, rectSum, neighborAvg, NB4
 """Anandan Model"""
 
 
@@ -51,42 +52,52 @@ class Anandan(MotionEST):
     """
 
   def intensity_hierarchy(self):
-    level = 0
-    self.cur_Is = []
-    self.ref_Is = []
-    #build each level itensity by using gaussian filters
-    while level <= self.levels:
-      cur_I = gaussian_filter(self.cur_yuv[:, :, 0], sigma=(2**level) * 0.56)
-      ref_I = gaussian_filter(self.ref_yuv[:, :, 0], sigma=(2**level) * 0.56)
-      self.ref_Is.append(ref_I)
-      self.cur_Is.append(cur_I)
-      level += 1
+    self.cur_Is = self.gaussian_hierarchy(self.cur_yuv)
+    self.ref_Is = self.gaussian_hierarchy(self.ref_yuv)
+
+  """
+    gaussian blurred luma of a frame at every level, cached by content
+    """
+
+  def gaussian_hierarchy(self, yuv):
+
+    def build():
+      #build each level itensity by using gaussian filters
+      return [
+          gaussian_filter(yuv[:, :, 0].astype(int), sigma=(2**level) * 0.56)
+          for level in xrange(self.levels + 1)
+      ]
+
+    return self.cached('gaussian hierarchy', [yuv[:, :, 0]], self.levels,
+                       build)
 
   """
     get curvature of each block
     """
 
   def get_curvature(self, I):
-    c_max = np.zeros((self.num_row, self.num_col))
-    c_min = np.zeros((self.num_row, self.num_col))
-    e_max = np.zeros((self.num_row, self.num_col, 2))
-    e_min = np.zeros((self.num_row, self.num_col, 2))
-    for r in xrange(self.num_row):
-      for c in xrange(self.num_col):
-        h11, h12, h21, h22 = 0, 0, 0, 0
-        for i in xrange(r * self.blk_sz, r * self.blk_sz + self.blk_sz):
-          for j in xrange(c * self.blk_sz, c * self.blk_sz + self.blk_sz):
-            if 0 <= i < self.height - 1 and 0 <= j < self.width - 1:
-              Ix = I[i][j + 1] - I[i][j]
-              Iy = I[i + 1][j] - I[i][j]
-              h11 += Iy * Iy
-              h12 += Ix * Iy
-              h21 += Ix * Iy
-              h22 += Ix * Ix
-        U, S, _ = LA.svd(np.array([[h11, h12], [h21, h22]]))
-        c_max[r, c], c_min[r, c] = S[0], S[1]
-        e_max[r, c] = U[:, 0]
-        e_min[r, c] = U[:, 1]
+    #gradients of every pixel but the last row and column, zero there
+    Ix = np.zeros(I.shape, dtype=I.dtype)
+    Iy = np.zeros(I.shape, dtype=I.dtype)
+    Ix[:-1, :-1] = I[:-1, 1:] - I[:-1, :-1]
+    Iy[:-1, :-1] = I[1:, :-1] - I[:-1, :-1]
+    ys = np.arange(self.num_row)[:, None] * self.blk_sz
+    xs = np.arange(self.num_col)[None, :] * self.blk_sz
+    h11 = rectSum(integralImage(Iy * Iy), ys, xs, self.blk_sz, self.blk_sz)
+    h12 = rectSum(integralImage(Ix * Iy), ys, xs, self.blk_sz, self.blk_sz)
+    h22 = rectSum(integralImage(Ix * Ix), ys, xs, self.blk_sz, self.blk_sz)
+    #eigen decomposition of the symmetric [[h11, h12], [h12, h22]]
+    mean = 0.5 * (h11 + h22)
+    radius = np.sqrt(0.25 * (h11 - h22)**2 + h12 * h12)
+    c_max = mean + radius
+    c_min = np.maximum(mean - radius, 0)
+    e_max = np.stack([h12, c_max - h11], axis=2).astype(float)
+    #diagonal matrices have axis aligned eigenvectors
+    diag = (h12 == 0)
+    e_max[diag & (h11 >= h22)] = [1, 0]
+    e_max[diag & (h11 < h22)] = [0, 1]
+    e_max /= LA.norm(e_max, axis=2)[:, :, None]
+    e_min = np.stack([-e_max[:, :, 1], e_max[:, :, 0]], axis=2)
     return c_max, c_min, e_max, e_min
 
   """
@@ -109,6 +120,30 @@ class Anandan(MotionEST):
             ssd += cur_I[r, c]**2
     return ssd
 
+  """
+    get ssd of every block, each with its own motion vector:
+      cur_I: current intensity
+      ref_I: reference intensity
+      mvs: motion vectors of block rows [r0, r0 + len(mvs))
+      r0: first block row
+    pixels moved out of the frame count as cur_I**2, as in get_ssd
+    """
+
+  def get_ssds(self, cur_I, ref_I, mvs, r0=0):
+    rows = mvs.shape[0]
+    offset = np.arange(self.blk_sz)
+    ys = (np.arange(r0, r0 + rows) * self.blk_sz)[:, None, None, None] + (
+        offset[:, None] + mvs[:, :, 0].astype(int)[:, :, None, None])
+    xs = (np.arange(self.num_col) * self.blk_sz)[None, :, None, None] + (
+        offset[None, :] + mvs[:, :, 1].astype(int)[:, :, None, None])
+    inside = (0 <= ys) & (ys < self.height) & (0 <= xs) & (xs < self.width)
+    ref_blks = ref_I[np.clip(ys, 0, self.height - 1),
+                     np.clip(xs, 0, self.width - 1)]
+    cur_blks = self.block_view(cur_I[:, :, None], r0 * self.blk_sz, 0,
+                               rows)[:, :, :, :, 0]
+    return np.sum(
+        np.where(inside, (ref_blks - cur_blks)**2, cur_blks**2), axis=(2, 3))
+
   """
     get region match of level l
       l: current level
@@ -117,32 +152,40 @@ class Anandan(MotionEST):
     """
 
   def region_match(self, l, last_mvs, radius):
-    mvs = np.zeros((self.num_row, self.num_col, 2))
-    min_ssds = np.zeros((self.num_row, self.num_col))
-    for r in xrange(self.num_row):
-      for c in xrange(self.num_col):
-        center = np.array([r * self.blk_sz, c * self.blk_sz])
-        #use overlap hierarchy policy
-        init_mvs = []
-        if last_mvs is None:
-          init_mvs = [np.array([0, 0])]
-        else:
+    return self.tile_map('region_match_rows', l, last_mvs, radius)
+
+  """
+    get region match of level l for block rows [r0, r1)
+    """
+
+  def region_match_rows(self, r0, r1, l, last_mvs, radius):
+    mvs = np.zeros((r1 - r0, self.num_col, 2))
+    min_ssds = np.full((r1 - r0, self.num_col), np.inf)
+    #use overlap hierarchy policy
+    if last_mvs is None:
+      init_mvs = np.zeros((1, r1 - r0, self.num_col, 2))
+      valids = np.ones((1, r1 - r0, self.num_col), dtype=bool)
+    else:
+      init_mvs = np.zeros((4, r1 - r0, self.num_col, 2))
+      valids = np.zeros((4, r1 - r0, self.num_col), dtype=bool)
+      #keep the per block candidate order so that ties resolve as before
+      for r in xrange(r0, r1):
+        for c in xrange(self.num_col):
+          k = 0
           for i, j in {(r, c), (r, c + 1), (r + 1, c), (r + 1, c + 1)}:
             if 0 <= i < last_mvs.shape[0] and 0 <= j < last_mvs.shape[1]:
-              init_mvs.append(last_mvs[i, j])
-        #use last matching results as the start position as current level
-        min_ssd = None
-        min_mv = None
-        for init_mv in init_mvs:
-          for i in xrange(-2, 3):
-            for j in xrange(-2, 3):
-              mv = init_mv + np.array([i, j]) * radius
-              ssd = self.get_ssd(self.cur_Is[l], self.ref_Is[l], center, mv)
-              if min_ssd is None or ssd < min_ssd:
-                min_ssd = ssd
-                min_mv = mv
-        min_ssds[r, c] = min_ssd
-        mvs[r, c] = min_mv
+              init_mvs[k, r - r0, c] = last_mvs[i, j]
+              valids[k, r - r0, c] = True
+              k += 1
+    #use last matching results as the start position as current level
+    for init_mv, valid in zip(init_mvs, valids):
+      for i in xrange(-2, 3):
+        for j in xrange(-2, 3):
+          mv = init_mv + np.array([i, j]) * radius
+          ssd = self.get_ssds(self.cur_Is[l], self.ref_Is[l], mv, r0)
+          better = valid & (ssd < min_ssds)
+          min_ssds[better] = ssd[better]
+          mvs[better] = mv[better]
     return mvs, min_ssds
 
   """
@@ -154,27 +197,15 @@ class Anandan(MotionEST):
     """
 
   def smooth(self, uvs, mvs, min_ssds, l):
-    sm_uvs = np.zeros((self.num_row, self.num_col, 2))
     c_max = self.c_maxs[l]
     c_min = self.c_mins[l]
-    e_max = self.e_maxs[l]
-    e_min = self.e_mins[l]
-    for r in xrange(self.num_row):
-      for c in xrange(self.num_col):
-        w_max = c_max[r, c] / (
-            self.k1 + self.k2 * min_ssds[r, c] + self.k3 * c_max[r, c])
-        w_min = c_min[r, c] / (
-            self.k1 + self.k2 * min_ssds[r, c] + self.k3 * c_min[r, c])
-        w = w_max * w_min / (w_max + w_min + 1e-6)
-        if w < 0:
-          w = 0
-        avg_uv = np.array([0.0, 0.0])
-        for i, j in {(r - 1, c), (r + 1, c), (r, c - 1), (r, c + 1)}:
-          if 0 <= i < self.num_row and 0 <= j < self.num_col:
-            avg_uv += 0.25 * uvs[i, j]
-        sm_uvs[r, c] = (w * w * mvs[r, c] + self.beta * avg_uv) / (
-            self.beta + w * w)
-    return sm_uvs
+    w_max = c_max / (self.k1 + self.k2 * min_ssds + self.k3 * c_max)
+    w_min = c_min / (self.k1 + self.k2 * min_ssds + self.k3 * c_min)
+    w = w_max * w_min / (w_max + w_min + 1e-6)
+    w[w < 0] = 0
+    ww = (w * w)[:, :, None]
+    avg_uv = neighborAvg(uvs, NB4)
+    return (ww * mvs + self.beta * avg_uv) / (self.beta + ww)
 
   """
     motion field estimation
@@ -182,12 +213,14 @@ class Anandan(MotionEST):
 
   def motion_field_estimation(self):
     last_mvs = None
-    for l in xrange(self.levels, -1, -1):
-      mvs, min_ssds = self.region_match(l, last_mvs, 2**l)
-      uvs = np.zeros(mvs.shape)
-      for _ in xrange(self.max_iter):
-        uvs = self.smooth(uvs, mvs, min_ssds, l)
-      last_mvs = uvs
+    #the levels share one pool of workers, see tile_pool
+    with self.tile_pool():
+      for l in xrange(self.levels, -1, -1):
+        mvs, min_ssds = self.region_match(l, last_mvs, 2**l)
+        uvs = np.zeros(mvs.shape)
+        for _ in xrange(self.max_iter):
+          uvs = self.smooth(uvs, mvs, min_ssds, l)
+        last_mvs = uvs
     for r in xrange(self.num_row):
       for c in xrange(self.num_col):
         self.mf[r, c] = uvs[r, c]
@@ -10,10 +10,112 @@
 # coding: utf-8
 import numpy as np
 import numpy.linalg as LA
-from Util import MSE
+from numpy.lib.stride_tricks import as_strided
+from Util import MSE, integralImage, rectSum, neighborAvg, NB8
+from Metric import SAD, SSE
 from MotionEST import MotionEST
 """Exhaust Search:"""
 
+#relative slack of the pruning tests, so that rounding never prunes the best
+#candidate
+PRUNE_SLACK = 1e-9
+#pixels of the candidate blocks gathered at once by the pruned search
+GATHER_BUDGET = 1 << 18
+#bytes of the search windows held at once, the blocks of a search are split
+#in chunks within it, whatever the frame and the window size
+WINDOW_BUDGET = 64 << 20
+#bytes window_losses holds per candidate, and the cost volumes
+LOSS_BYTES = 64
+COST_BYTES = 40
+"""
+  lower bound of a block distortion from the block sums:
+    metric: distortion metric
+    diff: difference of the block sums of every channel, shape (..., C)
+    n: number of pixels of a block
+  returns the bound, or None for metrics without one. by the triangle
+  inequality the mean of the per pixel norms of MSE is at least the norm of
+  the summed differences over n, SAD is at least the absolute luma sum
+  difference and by Cauchy-Schwarz SSE at least its square over n
+"""
+
+
+def sumBound(metric, diff, n):
+  if metric is MSE:
+    return np.sqrt(np.sum(np.square(diff, dtype=float), axis=-1)) / n
+  if metric is SAD:
+    return np.abs(diff[..., 0])
+  if metric is SSE:
+    return np.square(diff[..., 0], dtype=float) / n
+  return None
+
+
+"""
+  per pixel contributions of a metric:
+    metric: distortion metric
+    cur_blks, ref_blks: (batches of) blocks, or rows of them
+  returns an array of shape (..., h, w) whose mean for MSE, sum for SAD and
+  SSE, over the trailing axes is the metric, or None for other metrics
+"""
+
+
+def pixelDist(metric, cur_blks, ref_blks):
+  if metric is MSE:
+    diff = np.subtract(cur_blks, ref_blks, dtype=int)
+    return np.sqrt(np.einsum('...k,...k->...', diff, diff))
+  #the luma metrics
+  if metric is SAD:
+    return np.abs(np.subtract(cur_blks[..., 0], ref_blks[..., 0], dtype=int))
+  if metric is SSE:
+    return np.square(np.subtract(cur_blks[..., 0], ref_blks[..., 0], dtype=int))
+  return None
+
+
+"""
+  distortion of a batch of blocks with partial distortion elimination:
+    metric: distortion metric
+    cur_blks, ref_blks: blocks of shape (k, h, w, channels)
+    limit: loss each block has to stay within, shape (k,)
+  the top half of every block is scored first and only the blocks still
+  within their limit get the rest of their rows added. returns the metric
+  of every block, inf for the abandoned ones, or None for metrics pixelDist
+  does not know
+"""
+
+
+def partialDist(metric, cur_blks, ref_blks, limit):
+  h, w = cur_blks.shape[1:3]
+  half = h // 2
+  top = pixelDist(metric, cur_blks[:, :half], ref_blks[:, :half])
+  if top is None:
+    return None
+  partial = np.sum(top, axis=(1, 2))
+  if metric is MSE:
+    partial = partial / float(h * w)
+  alive = partial <= limit
+  #the whole per pixel map is reduced at once, as the metric does
+  pixels = np.empty((np.count_nonzero(alive), h, w), dtype=top.dtype)
+  pixels[:, :half] = top[alive]
+  pixels[:, half:] = pixelDist(metric, cur_blks[alive, half:],
+                               ref_blks[alive, half:])
+  loss = np.full(len(alive), np.inf)
+  if metric is MSE:
+    loss[alive] = np.mean(pixels, axis=(1, 2))
+  else:
+    loss[alive] = np.sum(pixels, axis=(1, 2))
+  return loss
+
+
+"""
+  first minimum of every window, in raster order as the search loops take it:
+    loss: losses of shape (k, candidates)
+  returns the index of the minimum of every window and its loss
+"""
+
+
+def windowMin(loss):
+  best = np.argmin(loss, axis=1)
+  return best, loss[np.arange(len(loss)), best]
+
 
 class Exhaust(MotionEST):
   """
@@ -25,11 +127,19 @@ class Exhaust(MotionEST):
         metric: metric to compare the blocks distrotion
     """
 
+  state = MotionEST.state + ('sea_pruned', 'pde_pruned')
+
   def __init__(self, cur_f, ref_f, blk_size, wnd_size, metric=MSE):
     self.name = 'exhaust'
     self.wnd_sz = wnd_size
     self.metric = metric
     super(Exhaust, self).__init__(cur_f, ref_f, blk_size)
+    #candidates skipped by their block sum bound, and those whose distortion
+    #was abandoned part way
+    self.sea_pruned = 0
+    self.pde_pruned = 0
+    #summed-area tables of the frames, built on first use
+    self.sums = None
 
   """
     search method:
@@ -43,30 +153,321 @@ class Exhaust(MotionEST):
     cur_y = cur_r * self.blk_sz
     ref_x = cur_x
     ref_y = cur_y
+    bounds = self.window_bounds(cur_r, cur_c)
     #search all validate positions and select the one with minimum distortion
     for y in xrange(cur_y - self.wnd_sz, cur_y + self.wnd_sz):
       for x in xrange(cur_x - self.wnd_sz, cur_x + self.wnd_sz):
         if 0 <= x < self.width - self.blk_sz and 0 <= y < self.height - self.blk_sz:
-          loss = self.block_dist(cur_r, cur_c, [y - cur_y, x - cur_x],
-                                 self.metric)
+          loss = self.bounded_dist(cur_r, cur_c, [y - cur_y, x - cur_x],
+                                   min_loss,
+                                   bound=bounds[y - cur_y + self.wnd_sz,
+                                                x - cur_x + self.wnd_sz])
           if loss < min_loss:
             min_loss = loss
             ref_x = x
             ref_y = y
     return ref_x, ref_y
 
+  """
+    summed-area tables of every channel of the current and the reference
+    frames, built on first use. they cost about as much as hashing the
+    frames would, so they are not cached by content, but built before the
+    tile workers fork so that those share them
+    """
+
+  def block_sums(self):
+    if self.sums is None:
+      self.sums = [
+          np.stack([integralImage(yuv[:, :, k]) for k in xrange(yuv.shape[2])],
+                   axis=2) for yuv in (self.cur_yuv, self.ref_yuv)
+      ]
+    return self.sums
+
+  """
+    block sum bounds of a block at every offset of the search window:
+      cur_r: current row
+      cur_c: current column
+    bounds[dy + wnd_sz, dx + wnd_sz] bounds the distortion at offset
+    (dy, dx), meaningless where the offset falls outside the frame. zero for
+    metrics without a bound, as distortions are never negative
+    """
+
+  def window_bounds(self, cur_r, cur_c):
+    blk_sz = self.blk_sz
+    cur_y, cur_x = cur_r * blk_sz, cur_c * blk_sz
+    offsets = np.arange(-self.wnd_sz, self.wnd_sz)
+    ys = np.clip(cur_y + offsets, 0, self.height - blk_sz)
+    xs = np.clip(cur_x + offsets, 0, self.width - blk_sz)
+    cur_S, ref_S = self.block_sums()
+    diff = (rectSum(cur_S, cur_y, cur_x, blk_sz, blk_sz) -
+            rectSum(ref_S, ys[:, None], xs[None, :], blk_sz, blk_sz))
+    bound = sumBound(self.metric, diff, blk_sz * blk_sz)
+    return np.zeros(diff.shape[:2]) if bound is None else bound
+
+  """
+    distortion of a block inside the frame, given the loss to beat:
+      cur_r: current row
+      cur_c: current column
+      mv: motion vector
+      min_loss: loss the candidate has to beat
+      extra: loss added to the distortion, such as a neighbor loss
+      bound: block sum bound of the candidate, see window_bounds. computed
+             here when not given
+    returns block_dist plus extra, or inf when the candidate can not beat
+    min_loss: either the block sum bound shows it (successive elimination),
+    or the distortion of the top half of the block already does (partial
+    distortion). only candidates that would lose anyway are skipped
+    """
+
+  def bounded_dist(self, cur_r, cur_c, mv, min_loss, extra=0, bound=None):
+    blk_sz = self.blk_sz
+    n = blk_sz * blk_sz
+    cur_y, cur_x = cur_r * blk_sz, cur_c * blk_sz
+    ref_y, ref_x = int(cur_y + mv[0]), int(cur_x + mv[1])
+    limit = min_loss + PRUNE_SLACK * (1 + abs(min_loss))
+    if bound is None:
+      cur_S, ref_S = self.block_sums()
+      diff = (rectSum(cur_S, cur_y, cur_x, blk_sz, blk_sz) -
+              rectSum(ref_S, ref_y, ref_x, blk_sz, blk_sz))
+      bound = sumBound(self.metric, diff, n)
+    if bound is not None and bound + extra > limit:
+      self.sea_pruned += 1
+      return np.inf
+    half = blk_sz // 2
+    cur_blk = self.cur_yuv[cur_y:cur_y + blk_sz, cur_x:cur_x + blk_sz]
+    ref_blk = self.ref_yuv[ref_y:ref_y + blk_sz, ref_x:ref_x + blk_sz]
+    top = pixelDist(self.metric, cur_blk[:half], ref_blk[:half])
+    if top is None:
+      return self.block_dist(cur_r, cur_c, mv, self.metric) + extra
+    partial = np.sum(top)
+    if self.metric is MSE:
+      partial = partial / float(n)
+    if partial + extra > limit:
+      self.pde_pruned += 1
+      return np.inf
+    #the rest of the rows, the whole per pixel map reduced as the metric does
+    pixels = np.concatenate(
+        (top, pixelDist(self.metric, cur_blk[half:], ref_blk[half:])))
+    if self.metric is MSE:
+      return np.mean(pixels, axis=(0, 1)) + extra
+    return np.sum(pixels) + extra
+
+  """
+    loss of every offset in the search window, pruned:
+      rs, cs: blocks to evaluate
+      min_loss: their loss at the zero motion vector
+      extra: loss added to every offset, shape (len(rs), 2 * wnd_sz,
+             2 * wnd_sz), such as a neighbor loss. None for none
+    the candidates of every block are scored in the order of their lower
+    bound, the block sum bound plus extra, in batches of growing size with
+    partial distortion elimination, until the next bound exceeds the best
+    loss of the block. only for metrics with a block sum bound. returns the
+    loss of every offset, shape (len(rs), 2 * wnd_sz, 2 * wnd_sz), inf
+    outside the frame and for the pruned candidates, which can not be the
+    first minimum nor beat min_loss, and the number of candidates of every
+    block skipped by their bound and abandoned part way
+    """
+
+  def window_losses(self, rs, cs, min_loss, extra=None):
+    wnd = self.wnd_sz
+    blk_sz = self.blk_sz
+    offset = np.arange(-wnd, wnd)
+    ys = rs[:, None] * blk_sz + offset
+    xs = cs[:, None] * blk_sz + offset
+    valid = (((0 <= ys) & (ys < self.height - blk_sz))[:, :, None] &
+             ((0 <= xs) & (xs < self.width - blk_sz))[:, None, :])
+    shape = valid.shape
+    valid = valid.reshape(len(rs), -1)
+    cur_S, ref_S = self.block_sums()
+    diff = (rectSum(cur_S, rs * blk_sz, cs * blk_sz, blk_sz,
+                    blk_sz)[:, None, None] -
+            rectSum(ref_S,
+                    np.clip(ys, 0, self.height - blk_sz)[:, :, None],
+                    np.clip(xs, 0, self.width - blk_sz)[:, None, :], blk_sz,
+                    blk_sz))
+    extra = np.zeros(valid.shape) if extra is None else extra.reshape(
+        len(rs), -1)
+    bound = sumBound(self.metric, diff, blk_sz * blk_sz)
+    lower = np.where(valid, bound.reshape(len(rs), -1) + extra, np.inf)
+    order = np.argsort(lower, axis=1)
+    lower = np.take_along_axis(lower, order, axis=1)
+    loss = np.full(lower.shape, np.inf)
+    limit = min_loss + PRUNE_SLACK * (1 + np.abs(min_loss))
+    evaluated = np.zeros(len(rs), dtype=int)
+    pde = np.zeros(len(rs), dtype=int)
+    cur_blks = self.block_view(self.cur_yuv)
+    #the reference block at every position, without copying
+    ref_yuv = np.ascontiguousarray(self.ref_yuv)
+    s0, s1, s2 = ref_yuv.strides
+    ref_blks = as_strided(
+        ref_yuv,
+        shape=(self.height - blk_sz + 1, self.width - blk_sz + 1, blk_sz,
+               blk_sz, ref_yuv.shape[2]),
+        strides=(s0, s1, s0, s1, s2),
+        writeable=False)
+    #blocks still searching, the next candidate rank and the batch size
+    blks = np.arange(len(rs))
+    k, size = 0, 4
+    while len(blks) and k < lower.shape[1]:
+      test = lower[blks, k:k + size] <= limit[blks, None]
+      b, j = np.nonzero(test)
+      b = blks[b]
+      cand = order[b, k + j]
+      ref_y = rs[b] * blk_sz + cand // (2 * wnd) - wnd
+      ref_x = cs[b] * blk_sz + cand % (2 * wnd) - wnd
+      cur = cur_blks[rs[b], cs[b]]
+      ref = ref_blks[ref_y, ref_x]
+      dist = partialDist(self.metric, cur, ref, limit[b] - extra[b, cand])
+      total = dist + extra[b, cand]
+      loss[b, cand] = total
+      np.minimum.at(limit, b, total + PRUNE_SLACK * (1 + np.abs(total)))
+      np.add.at(evaluated, b, 1)
+      np.add.at(pde, b, np.isinf(dist))
+      k += size
+      #candidates come in increasing bound, a block is done at the first one
+      #out of its limit
+      if k < lower.shape[1]:
+        blks = blks[lower[blks, k] <= limit[blks]]
+      #double the batches, within about GATHER_BUDGET gathered pixels
+      size = max(
+          1, min(2 * size,
+                 GATHER_BUDGET // (max(1, len(blks)) * blk_sz * blk_sz)))
+    return loss.reshape(shape), np.sum(valid, axis=1) - evaluated, pde
+
+  """
+    split blocks in chunks whose search windows fit WINDOW_BUDGET:
+      n: number of blocks, or of block rows
+      nbytes: bytes held per candidate of a block, or of a block row
+    returns the slices of the chunks
+    """
+
+  def window_chunks(self, n, nbytes):
+    size = max(1, WINDOW_BUDGET // (4 * self.wnd_sz**2 * nbytes))
+    return [slice(k, min(n, k + size)) for k in xrange(0, n, size)]
+
+  """
+    distortion of every block at the zero motion vector:
+      r0, r1: range of block rows to evaluate, all rows by default
+    blocks whose zero motion vector falls outside the frame score against an
+    empty block, as in block_dist
+    """
+
+  def zero_dist(self, r0=0, r1=None):
+    r1 = self.num_row if r1 is None else r1
+    blk_sz = self.blk_sz
+    cur_blks = self.block_view(self.cur_yuv, r0 * blk_sz, 0, r1 - r0)
+    zero_loss = self.metric(
+        cur_blks, self.block_view(self.ref_yuv, r0 * blk_sz, 0, r1 - r0))
+    valid = np.outer(
+        np.arange(r0, r1) * blk_sz < self.height - blk_sz,
+        np.arange(self.num_col) * blk_sz < self.width - blk_sz)
+    if not valid.all():
+      empty = np.zeros((blk_sz, blk_sz, self.cur_yuv.shape[2]))
+      zero_loss[~valid] = self.metric(cur_blks[~valid], empty)
+    return zero_loss
+
+  """
+    distortion of every block at every offset in the search window:
+      r0, r1: range of block rows to evaluate, all rows by default
+      cost[r, c, dy + wnd_sz, dx + wnd_sz] is the distortion of block
+      (r0 + r, c) at offset (dy, dx), inf where the offset falls outside the
+      frame. returns the cost volume and the distortion of the zero motion
+      vector
+    """
+
+  def cost_volume(self, r0=0, r1=None):
+    r1 = self.num_row if r1 is None else r1
+    wnd = self.wnd_sz
+    blk_sz = self.blk_sz
+    cost = np.full((r1 - r0, self.num_col, 2 * wnd, 2 * wnd), np.inf)
+    cur_blks = self.block_view(self.cur_yuv, r0 * blk_sz, 0, r1 - r0)
+    #pad the reference rows of the band so every offset of every block can
+    #be sliced
+    y0, y1 = r0 * blk_sz - wnd, r1 * blk_sz + wnd
+    ref_pad = np.pad(
+        self.ref_yuv[max(0, y0):y1],
+        ((max(0, -y0), max(0, y1 - self.height)), (wnd, wnd), (0, 0)),
+        mode='constant')
+    ys = np.arange(r0, r1) * blk_sz
+    xs = np.arange(self.num_col) * blk_sz
+    for dy in xrange(-wnd, wnd):
+      valid_y = (0 <= ys + dy) & (ys + dy < self.height - blk_sz)
+      for dx in xrange(-wnd, wnd):
+        valid_x = (0 <= xs + dx) & (xs + dx < self.width - blk_sz)
+        if not valid_y.any() or not valid_x.any():
+          continue
+        ref_blks = self.block_view(ref_pad, wnd + dy, wnd + dx, r1 - r0)
+        loss = self.metric(cur_blks, ref_blks)
+        valid = np.outer(valid_y, valid_x)
+        cost[valid, dy + wnd, dx + wnd] = loss[valid]
+    return cost, self.zero_dist(r0, r1)
+
+  """
+    exhaust search of a band of block rows:
+      r0, r1: range of block rows to search
+    returns the motion vectors of the band, same as search block by block,
+    and the number of candidates of every block skipped by their block sum
+    bound and abandoned part way, see window_losses
+    """
+
+  def match_rows(self, r0, r1):
+    wnd = self.wnd_sz
+    shape = (r1 - r0, self.num_col)
+    n = shape[0] * shape[1]
+    best = np.zeros(n, dtype=int)
+    min_loss = np.zeros(n)
+    sea = np.zeros(n, dtype=int)
+    pde = np.zeros(n, dtype=int)
+    if sumBound(self.metric, np.zeros(1), 1) is None:
+      zero_loss = np.zeros(n)
+      #the volume is filled and reduced a few block rows at a time
+      for rows in self.window_chunks(r1 - r0, COST_BYTES * self.num_col):
+        blks = slice(rows.start * self.num_col, rows.stop * self.num_col)
+        cost, zero = self.cost_volume(r0 + rows.start, r0 + rows.stop)
+        best[blks], min_loss[blks] = windowMin(cost.reshape(zero.size, -1))
+        zero_loss[blks] = zero.ravel()
+    else:
+      rs, cs = np.mgrid[r0:r1, 0:self.num_col]
+      rs, cs = rs.ravel(), cs.ravel()
+      zero_loss = self.zero_dist(r0, r1).ravel()
+      #the windows of all the blocks may not fit in memory at once
+      for blks in self.window_chunks(n, LOSS_BYTES):
+        loss, sea[blks], pde[blks] = self.window_losses(
+            rs[blks], cs[blks], zero_loss[blks])
+        best[blks], min_loss[blks] = windowMin(loss.reshape(len(loss), -1))
+    #the first minimum in raster order wins, as in search
+    moved = min_loss < zero_loss
+    mvs = np.zeros((n, 2))
+    mvs[:, 0] = np.where(moved, best // (2 * wnd) - wnd, 0)
+    mvs[:, 1] = np.where(moved, best % (2 * wnd) - wnd, 0)
+    return mvs.reshape(shape + (2,)), sea.reshape(shape), pde.reshape(shape)
+
+  """
+    number of block distortions a full search evaluates: every offset of the
+    window that falls inside the frame, and the zero motion vector
+    """
+
+  def window_evaluations(self):
+    offset = np.arange(-self.wnd_sz, self.wnd_sz)
+    ys = np.arange(self.num_row)[:, None] * self.blk_sz + offset
+    xs = np.arange(self.num_col)[:, None] * self.blk_sz + offset
+    n_y = np.sum((0 <= ys) & (ys < self.height - self.blk_sz), axis=1)
+    n_x = np.sum((0 <= xs) & (xs < self.width - self.blk_sz), axis=1)
+    return int(np.sum(np.outer(n_y, n_x))) + self.num_row * self.num_col
+
   def motion_field_estimation(self):
-    for i in xrange(self.num_row):
-      for j in xrange(self.num_col):
-        ref_x, ref_y = self.search(i, j)
-        self.mf[i, j] = np.array(
-            [ref_y - i * self.blk_sz, ref_x - j * self.blk_sz])
+    if sumBound(self.metric, np.zeros(1), 1) is not None:
+      self.block_sums()
+    self.mf, sea, pde = self.tile_map('match_rows')
+    self.sea_pruned = int(np.sum(sea))
+    self.pde_pruned = int(np.sum(pde))
+    self.evaluations = self.window_evaluations() - self.sea_pruned
 
 
 """Exhaust with Neighbor Constraint"""
 
 
-class ExhaustNeighbor(MotionEST):
+class ExhaustNeighbor(Exhaust):
   """
     Constructor:
         cur_f: current frame
@@ -78,11 +479,10 @@ class ExhaustNeighbor(MotionEST):
     """
 
   def __init__(self, cur_f, ref_f, blk_size, wnd_size, beta, metric=MSE):
-    self.name = 'exhaust + neighbor'
-    self.wnd_sz = wnd_size
     self.beta = beta
-    self.metric = metric
-    super(ExhaustNeighbor, self).__init__(cur_f, ref_f, blk_size)
+    super(ExhaustNeighbor, self).__init__(cur_f, ref_f, blk_size, wnd_size,
+                                          metric)
+    self.name = 'exhaust + neighbor'
     self.assign = np.zeros((self.num_row, self.num_col), dtype=bool)
 
   """
@@ -117,34 +517,129 @@ class ExhaustNeighbor(MotionEST):
     cur_y = cur_r * self.blk_sz
     ref_x = cur_x
     ref_y = cur_y
+    bounds = self.window_bounds(cur_r, cur_c)
     #search all validate positions and select the one with minimum distortion
     # as well as weighted neighbor loss
     for y in xrange(cur_y - self.wnd_sz, cur_y + self.wnd_sz):
       for x in xrange(cur_x - self.wnd_sz, cur_x + self.wnd_sz):
         if 0 <= x < self.width - self.blk_sz and 0 <= y < self.height - self.blk_sz:
-          dist_loss = self.block_dist(cur_r, cur_c, [y - cur_y, x - cur_x],
-                                      self.metric)
           nb_loss = self.neighborLoss(cur_r, cur_c, [y - cur_y, x - cur_x])
-          loss = dist_loss + self.beta * nb_loss
+          loss = self.bounded_dist(cur_r, cur_c, [y - cur_y, x - cur_x],
+                                   min_loss, self.beta * nb_loss,
+                                   bounds[y - cur_y + self.wnd_sz,
+                                          x - cur_x + self.wnd_sz])
           if loss < min_loss:
             min_loss = loss
             ref_x = x
             ref_y = y
     return ref_x, ref_y
 
+  """
+    neighbor loss of every offset in the search window:
+      rs, cs: blocks to evaluate, whose assigned neighbors are known
+    returns an array of shape (len(rs), 2 * wnd_sz, 2 * wnd_sz), the
+    vectorized neighborLoss of each block at each offset
+    """
+
+  def neighborLosses(self, rs, cs):
+    offset = np.arange(-self.wnd_sz, self.wnd_sz)
+    loss = np.zeros((len(rs), 2 * self.wnd_sz, 2 * self.wnd_sz))
+    for i, j in ((-1, 0), (1, 0), (0, 1), (0, -1)):
+      nb_r = rs + i
+      nb_c = cs + j
+      valid = (0 <= nb_r) & (nb_r < self.num_row) & (0 <= nb_c) & (
+          nb_c < self.num_col)
+      valid[valid] = self.assign[nb_r[valid], nb_c[valid]]
+      nb_mv = self.mf[nb_r[valid], nb_c[valid]]
+      dy = offset[None, :, None] - nb_mv[:, 0, None, None]
+      dx = offset[None, None, :] - nb_mv[:, 1, None, None]
+      loss[valid] += np.sqrt(dy * dy + dx * dx)
+    return loss
+
+  """
+    candidates of a band of block rows that may beat the zero motion vector:
+      r0, r1: range of block rows to evaluate
+    in the wavefront a block has at most its top and left neighbors
+    assigned, and by the triangle inequality the neighbor loss of an offset
+    is at most 2 * |offset| below the one of the zero motion vector. the
+    offsets whose distortion exceeds the zero one by more can not be chosen
+    and are dropped. returns the number of candidates kept by every block,
+    shape (r1 - r0, num_col), their offset indices into the flattened window
+    and their distortions, in raster order of the blocks, and the distortion
+    of the zero motion vector
+    """
+
+  def window_candidates(self, r0, r1):
+    wnd = self.wnd_sz
+    offset = np.arange(-wnd, wnd)
+    reach = 2 * abs(self.beta) * np.sqrt(offset[:, None]**2 +
+                                         offset[None, :]**2)
+    counts, cands, losses, zeros = [], [], [], []
+    #the volume is filled and reduced a few block rows at a time
+    for rows in self.window_chunks(r1 - r0, COST_BYTES * self.num_col):
+      cost, zero_loss = self.cost_volume(r0 + rows.start, r0 + rows.stop)
+      cost = cost.reshape(zero_loss.size, -1)
+      limit = zero_loss.reshape(-1, 1) + reach.ravel()
+      keep = cost <= limit + PRUNE_SLACK * (1 + np.abs(limit))
+      blk, cand = np.nonzero(keep)
+      counts.append(np.sum(keep, axis=1).reshape(zero_loss.shape))
+      cands.append(cand.astype(np.int32))
+      losses.append(cost[blk, cand])
+      zeros.append(zero_loss)
+    return tuple(np.concatenate(a) for a in (counts, cands, losses, zeros))
+
   def motion_field_estimation(self):
-    for i in xrange(self.num_row):
-      for j in xrange(self.num_col):
-        ref_x, ref_y = self.search(i, j)
-        self.mf[i, j] = np.array(
-            [ref_y - i * self.blk_sz, ref_x - j * self.blk_sz])
-        self.assign[i, j] = True
+    wnd = self.wnd_sz
+    #metrics without a block sum bound score the whole window of every block
+    #up front, the block distortions do not depend on the neighbors. the
+    #workers only send back the candidates that may be chosen
+    bounded = sumBound(self.metric, np.zeros(1), 1) is not None
+    if bounded:
+      zero_loss = self.zero_dist()
+    else:
+      count, cand, cand_loss, zero_loss = self.tile_map('window_candidates')
+      #where the candidates of every block start
+      start = np.cumsum(count.ravel()) - count.ravel()
+    self.sea_pruned = 0
+    self.pde_pruned = 0
+    self.assign[:] = False
+    #a block only depends on its top and left neighbors, so the blocks of an
+    #anti-diagonal are independent once the previous diagonals are assigned
+    for d in xrange(self.num_row + self.num_col - 1):
+      diag_rs = np.arange(
+          max(0, d - self.num_col + 1), min(self.num_row, d + 1))
+      #the blocks of a diagonal are independent, and searched in chunks
+      for blks in self.window_chunks(len(diag_rs), LOSS_BYTES):
+        rs = diag_rs[blks]
+        cs = d - rs
+        nb_loss = self.neighborLosses(rs, cs)
+        min_loss = zero_loss[rs, cs] + self.beta * nb_loss[:, wnd, wnd]
+        if bounded:
+          loss, sea, pde = self.window_losses(rs, cs, min_loss,
+                                              self.beta * nb_loss)
+          self.sea_pruned += int(np.sum(sea))
+          self.pde_pruned += int(np.sum(pde))
+        else:
+          #the windows of the chunk from their kept candidates, inf elsewhere
+          n = count[rs, cs]
+          idx = np.arange(np.sum(n)) + np.repeat(
+              start[rs * self.num_col + cs] - np.cumsum(n) + n, n)
+          loss = np.full((len(rs), 4 * wnd * wnd), np.inf)
+          loss[np.repeat(np.arange(len(rs)), n), cand[idx]] = cand_loss[idx]
+          loss = loss.reshape(nb_loss.shape) + self.beta * nb_loss
+        #the first minimum in raster order wins, as in search
+        best, loss = windowMin(loss.reshape(len(rs), -1))
+        moved = loss < min_loss
+        self.mf[rs, cs, 0] = np.where(moved, best // (2 * wnd) - wnd, 0)
+        self.mf[rs, cs, 1] = np.where(moved, best % (2 * wnd) - wnd, 0)
+      self.assign[diag_rs, d - diag_rs] = True
+    self.evaluations = self.window_evaluations() - self.sea_pruned
 
 
 """Exhaust with Neighbor Constraint and Feature Score"""
 
 
-class ExhaustNeighborFeatureScore(MotionEST):
+class ExhaustNeighborFeatureScore(Exhaust):
   """
     Constructor:
         cur_f: current frame
@@ -164,12 +659,11 @@ class ExhaustNeighborFeatureScore(MotionEST):
                beta=1,
                max_iter=100,
                metric=MSE):
-    self.name = 'exhaust + neighbor+feature score'
-    self.wnd_sz = wnd_size
     self.beta = beta
-    self.metric = metric
     self.max_iter = max_iter
-    super(ExhaustNeighborFeatureScore, self).__init__(cur_f, ref_f, blk_size)
+    super(ExhaustNeighborFeatureScore, self).__init__(cur_f, ref_f, blk_size,
+                                                      wnd_size, metric)
+    self.name = 'exhaust + neighbor+feature score'
     self.fs = self.getFeatureScore()
 
   """
@@ -177,83 +671,153 @@ class ExhaustNeighborFeatureScore(MotionEST):
     """
 
   def getFeatureScore(self):
-    fs = np.zeros((self.num_row, self.num_col))
-    for r in xrange(self.num_row):
-      for c in xrange(self.num_col):
-        IxIx = 0
-        IyIy = 0
-        IxIy = 0
-        #get ssd surface
-        for x in xrange(self.blk_sz - 1):
-          for y in xrange(self.blk_sz - 1):
-            ox = c * self.blk_sz + x
-            oy = r * self.blk_sz + y
-            Ix = self.cur_yuv[oy, ox + 1, 0] - self.cur_yuv[oy, ox, 0]
-            Iy = self.cur_yuv[oy + 1, ox, 0] - self.cur_yuv[oy, ox, 0]
-            IxIx += Ix * Ix
-            IyIy += Iy * Iy
-            IxIy += Ix * Iy
-        #get maximum and minimum eigenvalues
-        lambda_max = 0.5 * ((IxIx + IyIy) + np.sqrt(4 * IxIy * IxIy +
-                                                    (IxIx - IyIy)**2))
-        lambda_min = 0.5 * ((IxIx + IyIy) - np.sqrt(4 * IxIy * IxIy +
-                                                    (IxIx - IyIy)**2))
-        fs[r, c] = lambda_max * lambda_min / (1e-6 + lambda_max + lambda_min)
-        if fs[r, c] < 0:
-          fs[r, c] = 0
+    I = self.cur_yuv[:, :, 0].astype(int)
+    #gradients of the whole frame
+    Ix = I[:-1, 1:] - I[:-1, :-1]
+    Iy = I[1:, :-1] - I[:-1, :-1]
+    #each block sums the gradients of its top left (blk_sz-1)^2 pixels
+    ys = np.arange(self.num_row)[:, None] * self.blk_sz
+    xs = np.arange(self.num_col)[None, :] * self.blk_sz
+    sz = self.blk_sz - 1
+    IxIx = rectSum(integralImage(Ix * Ix), ys, xs, sz, sz)
+    IyIy = rectSum(integralImage(Iy * Iy), ys, xs, sz, sz)
+    IxIy = rectSum(integralImage(Ix * Iy), ys, xs, sz, sz)
+    #get maximum and minimum eigenvalues
+    lambda_max = 0.5 * ((IxIx + IyIy) + np.sqrt(4 * IxIy * IxIy +
+                                                (IxIx - IyIy)**2))
+    lambda_min = 0.5 * ((IxIx + IyIy) - np.sqrt(4 * IxIy * IxIy +
+                                                (IxIx - IyIy)**2))
+    fs = lambda_max * lambda_min / (1e-6 + lambda_max + lambda_min)
+    fs[fs < 0] = 0
     return fs
 
-  """
-    do exhaust search
-    """
-
-  def search(self, cur_r, cur_c):
-    min_loss = self.block_dist(cur_r, cur_c, [0, 0], self.metric)
-    cur_x = cur_c * self.blk_sz
-    cur_y = cur_r * self.blk_sz
-    ref_x = cur_x
-    ref_y = cur_y
-    #search all validate positions and select the one with minimum distortion
-    for y in xrange(cur_y - self.wnd_sz, cur_y + self.wnd_sz):
-      for x in xrange(cur_x - self.wnd_sz, cur_x + self.wnd_sz):
-        if 0 <= x < self.width - self.blk_sz and 0 <= y < self.height - self.blk_sz:
-          loss = self.block_dist(cur_r, cur_c, [y - cur_y, x - cur_x],
-                                 self.metric)
-          if loss < min_loss:
-            min_loss = loss
-            ref_x = x
-            ref_y = y
-    return ref_x, ref_y
-
   """
     add smooth constraint
     """
 
   def smooth(self, uvs, mvs):
-    sm_uvs = np.zeros(uvs.shape)
-    for r in xrange(self.num_row):
-      for c in xrange(self.num_col):
-        avg_uv = np.array([0.0, 0.0])
-        for i, j in {(r - 1, c), (r + 1, c), (r, c - 1), (r, c + 1)}:
-          if 0 <= i < self.num_row and 0 <= j < self.num_col:
-            avg_uv += uvs[i, j] / 6.0
-        for i, j in {(r - 1, c - 1), (r - 1, c + 1), (r + 1, c - 1),
-                     (r + 1, c + 1)}:
-          if 0 <= i < self.num_row and 0 <= j < self.num_col:
-            avg_uv += uvs[i, j] / 12.0
-        sm_uvs[r, c] = (self.fs[r, c] * mvs[r, c] + self.beta * avg_uv) / (
-            self.beta + self.fs[r, c])
-    return sm_uvs
+    fs = self.fs[:, :, None]
+    avg_uv = neighborAvg(uvs, NB8)
+    return (fs * mvs + self.beta * avg_uv) / (self.beta + fs)
 
   def motion_field_estimation(self):
     #get matching results
-    mvs = np.zeros(self.mf.shape)
-    for r in xrange(self.num_row):
-      for c in xrange(self.num_col):
-        ref_x, ref_y = self.search(r, c)
-        mvs[r, c] = np.array([ref_y - r * self.blk_sz, ref_x - c * self.blk_sz])
+    if sumBound(self.metric, np.zeros(1), 1) is not None:
+      self.block_sums()
+    mvs = self.tile_map('match_rows')[0]
     #add smoothness constraint
     uvs = np.zeros(self.mf.shape)
     for _ in xrange(self.max_iter):
       uvs = self.smooth(uvs, mvs)
     self.mf = uvs
+
+
+"""Exhaust on a Pyramid"""
+
+
+class ExhaustPyramid(Exhaust):
+  """
+    Constructor:
+        cur_f: current frame
+        ref_f: reference frame
+        blk_sz: block size, divisible by 2 ** levels
+        wnd_size: search window size at full resolution
+        levels: number of times the luma is halved
+        refine: radius of the refinement window at every lower level
+        metric: metric to compare the blocks distrotion
+    a full search with the window scaled down runs on the top of the luma
+    pyramid, the block size shrinking with the frame so that every level has
+    the same blocks. each lower level doubles the vectors of the level above
+    and searches the (2 * refine + 1) ** 2 offsets around them, the full
+    resolution level comparing all the channels
+    """
+
+  def __init__(self,
+               cur_f,
+               ref_f,
+               blk_size,
+               wnd_size,
+               levels=2,
+               refine=2,
+               metric=MSE):
+    if blk_size % 2**levels:
+      raise ValueError('block size %d cannot be halved %d times' %
+                       (blk_size, levels))
+    self.levels = levels
+    self.refine = refine
+    super(ExhaustPyramid, self).__init__(cur_f, ref_f, blk_size, wnd_size,
+                                         metric)
+    self.name = 'exhaust pyramid'
+
+  """
+    luma pyramid of a frame:
+      yuv: frame
+    returns the luma planes of shape (height, width, 1) from full resolution
+    to the top, each the 2x2 average of the one below, cached by content
+    """
+
+  def pyramid(self, yuv):
+
+    def build():
+      I = yuv[:, :, 0].astype(int)
+      planes = [I[:, :, None]]
+      for _ in xrange(self.levels):
+        h, w = I.shape[0] // 2 * 2, I.shape[1] // 2 * 2
+        I = (I[0:h:2, 0:w:2] + I[1:h:2, 0:w:2] + I[0:h:2, 1:w:2] +
+             I[1:h:2, 1:w:2] + 2) // 4
+        planes.append(I[:, :, None])
+      return planes
+
+    return self.cached('luma pyramid', [yuv[:, :, 0]], self.levels, build)
+
+  """
+    refine a motion field on one level:
+      est: estimator of the level
+      mvs: predicted motion vectors at the resolution of the level
+    returns the refined motion vectors, the prediction winning ties, and the
+    number of block distortions evaluated
+    """
+
+  def refine_level(self, est, mvs):
+    blk_sz = est.blk_sz
+    cur_y = np.arange(est.num_row)[:, None] * blk_sz
+    cur_x = np.arange(est.num_col)[None, :] * blk_sz
+    best = mvs.copy()
+    min_loss = np.full(mvs.shape[:2], np.inf)
+    evaluations = 0
+    #the prediction first, then the other offsets in raster order
+    offsets = [(0, 0)] + [(dy, dx)
+                          for dy in xrange(-self.refine, self.refine + 1)
+                          for dx in xrange(-self.refine, self.refine + 1)
+                          if dy or dx]
+    for dy, dx in offsets:
+      cand = mvs + np.array([dy, dx])
+      ref_y = cur_y + cand[:, :, 0]
+      ref_x = cur_x + cand[:, :, 1]
+      valid = (0 <= ref_x) & (ref_x < est.width - blk_sz) & (0 <= ref_y) & (
+          ref_y < est.height - blk_sz)
+      loss = np.where(valid, est.field_dist(cand, self.metric), np.inf)
+      better = loss < min_loss
+      best[better] = cand[better]
+      min_loss[better] = loss[better]
+      evaluations += np.sum(valid)
+    return best, evaluations
+
+  def motion_field_estimation(self):
+    cur_pyr = self.pyramid(self.cur_yuv)
+    ref_pyr = self.pyramid(self.ref_yuv)
+    scale = 2**self.levels
+    top = Exhaust(cur_pyr[-1], ref_pyr[-1], self.blk_sz // scale,
+                  -(-self.wnd_sz // scale), self.metric)
+    top.workers = self.workers
+    top.motion_field_estimation()
+    mvs = top.mf
+    self.evaluations = top.evaluations
+    for l in xrange(self.levels - 1, -1, -1):
+      if l == 0:
+        est = self
+      else:
+        est = MotionEST(cur_pyr[l], ref_pyr[l], self.blk_sz >> l)
+      mvs, evaluations = self.refine_level(est, 2 * mvs)
+      self.evaluations += evaluations
+    self.mf = mvs
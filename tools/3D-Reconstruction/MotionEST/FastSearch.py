@@ -0,0 +1,335 @@
+##  Copyright (c) 2020 The WebM project authors. All Rights Reserved.
+##
+##  Use of this source code is governed by a BSD-style license
+##  that can be found in the LICENSE file in the root of the source
+##  tree. An additional intellectual property rights grant can be found
+##  in the file PATENTS.  All contributing project authors may
+##  be found in the AUTHORS file in the root of the source tree.
+##
+
+# coding: utf-8
+import numpy as np
+from Util import MSE
+from MotionEST import MotionEST
+"""Fast Search:
+
+  pattern searches in the style of the libvpx encoder. every block walks its
+  own path, and the blocks are stepped together so that each step scores the
+  pattern of all the blocks still moving in one batched metric call
+"""
+
+#(row, column) offsets of the search patterns
+SMALL_DIAMOND = np.array([[-1, 0], [0, -1], [0, 1], [1, 0]])
+LARGE_DIAMOND = np.array([[-2, 0], [-1, -1], [-1, 1], [0, -2], [0, 2], [1, -1],
+                          [1, 1], [2, 0]])
+HEXAGON = np.array([[-1, -2], [1, -2], [2, 0], [1, 2], [-1, 2], [-2, 0]])
+
+
+class FastSearch(MotionEST):
+  """
+    Constructor:
+        cur_f: current frame
+        ref_f: reference frame
+        blk_sz: block size
+        wnd_size: search window size, motion vector components lie in
+                  [-wnd_size, wnd_size) as in the exhaustive search
+        metric: metric to compare the blocks distrotion
+    self.evaluations counts the block distortions evaluated by the last
+    estimation, and self.block_evaluations holds the count of every block.
+    every offset is scored at most once per block
+    """
+
+  def __init__(self, cur_f, ref_f, blk_size, wnd_size, metric=MSE):
+    self.wnd_sz = wnd_size
+    self.metric = metric
+    super(FastSearch, self).__init__(cur_f, ref_f, blk_size)
+    self.block_evaluations = None
+    #offsets of the window each block has scored, one bit per offset
+    self.visited = None
+
+  """forget the offsets scored by the blocks"""
+
+  def clear_visited(self):
+    n = 2 * self.wnd_sz
+    self.visited = np.zeros((self.num_row, self.num_col, n, (n + 7) // 8),
+                            dtype=np.uint8)
+
+  """
+    candidates not scored yet, marked as scored:
+      rs, cs: blocks, arrays of shape (n,)
+      mvs: integer candidates of shape (n, k, 2)
+    returns a mask of shape (n, k), false for the candidates already scored
+    and for those outside the window, which are never scored
+    """
+
+  def unvisited(self, rs, cs, mvs):
+    wnd = self.wnd_sz
+    new = np.all((-wnd <= mvs) & (mvs < wnd), axis=2)
+    b, j = np.nonzero(new)
+    y = mvs[b, j, 0] + wnd
+    x = mvs[b, j, 1] + wnd
+    idx = (rs[b], cs[b], y, x >> 3)
+    bit = (1 << (x & 7)).astype(np.uint8)
+    new[b, j] = (self.visited[idx] & bit) == 0
+    np.bitwise_or.at(self.visited, idx, bit)
+    return new
+
+  """
+    distortion of blocks at candidate motion vectors:
+      rs, cs: blocks, arrays of shape (n,)
+      mvs: integer candidates of shape (n, k, 2)
+    returns an array of shape (n, k), inf for candidates outside the window
+    or the frame. as in block_dist, the zero motion vector is always scored,
+    against an empty block when it falls outside the frame
+    """
+
+  def dist(self, rs, cs, mvs):
+    blk_sz = self.blk_sz
+    cur_blks = self.block_view(self.cur_yuv)[rs, cs][:, None]
+    ref_y = rs[:, None] * blk_sz + mvs[:, :, 0]
+    ref_x = cs[:, None] * blk_sz + mvs[:, :, 1]
+    valid = (0 <= ref_x) & (ref_x < self.width - blk_sz) & (0 <= ref_y) & (
+        ref_y < self.height - blk_sz)
+    offset = np.arange(blk_sz)
+    ref_blks = self.ref_yuv[
+        np.where(valid, ref_y, 0)[:, :, None, None] + offset[:, None],
+        np.where(valid, ref_x, 0)[:, :, None, None] + offset[None, :]]
+    ref_blks[~valid] = 0
+    loss = self.metric(cur_blks, ref_blks).astype(float)
+    inside = valid & np.all((-self.wnd_sz <= mvs) & (mvs < self.wnd_sz), axis=2)
+    zero = np.all(mvs == 0, axis=2)
+    loss[~(inside | zero)] = np.inf
+    return loss
+
+  """
+    move blocks to their best candidate when it beats their current one:
+      rs, cs, mvs, costs, counts: state of the blocks being searched
+      sel: indices of the blocks to step
+      cands: candidates of the selected blocks, shape (len(sel), k, 2)
+      skip: optional mask of shape (len(sel), k), candidates left unscored
+    only the candidates a block has not scored before are scored, the others
+    can not beat its current one. the first best candidate wins. returns the
+    indices of the blocks that moved and the index of the candidate they
+    moved to
+    """
+
+  def step(self, rs, cs, mvs, costs, counts, sel, cands, skip=None):
+    new = self.unvisited(rs[sel], cs[sel], cands)
+    if skip is not None:
+      new &= ~skip
+    b, j = np.nonzero(new)
+    loss = np.full(new.shape, np.inf)
+    if len(b):
+      blks = sel[b]
+      loss[b, j] = self.dist(rs[blks], cs[blks], cands[b, j][:, None])[:, 0]
+    counts[sel] += np.sum(np.isfinite(loss), axis=1)
+    best = np.argmin(loss, axis=1)
+    min_loss = loss[np.arange(len(sel)), best]
+    better = min_loss < costs[sel]
+    mvs[sel[better]] = cands[better, best[better]]
+    costs[sel[better]] = min_loss[better]
+    return sel[better], best[better]
+
+  """
+    repeat a pattern around the selected blocks until none of them moves
+    """
+
+  def pattern_search(self, rs, cs, mvs, costs, counts, sel, pattern):
+    while len(sel):
+      sel, _ = self.step(rs, cs, mvs, costs, counts, sel,
+                         mvs[sel][:, None] + pattern)
+
+  """
+    search a band of block rows from the zero motion vector:
+      r0, r1: range of block rows to search
+    returns the motion vectors and the evaluation counts of the band
+    """
+
+  def search_rows(self, r0, r1):
+    rs, cs = np.mgrid[r0:r1, 0:self.num_col]
+    rs, cs = rs.ravel(), cs.ravel()
+    mvs = np.zeros((len(rs), 2), dtype=int)
+    counts = np.ones(len(rs), dtype=int)
+    self.clear_visited()
+    self.unvisited(rs, cs, mvs[:, None])
+    costs = self.dist(rs, cs, mvs[:, None])[:, 0]
+    self.search_blocks(rs, cs, mvs, costs, counts)
+    shape = (r1 - r0, self.num_col)
+    return mvs.reshape(shape + (2,)).astype(float), counts.reshape(shape)
+
+  """search strategy, overridden by child classes"""
+
+  def search_blocks(self, rs, cs, mvs, costs, counts):
+    pass
+
+  def motion_field_estimation(self):
+    self.mf, self.block_evaluations = self.tile_map('search_rows')
+    self.evaluations = int(np.sum(self.block_evaluations))
+
+
+"""Small Diamond Search"""
+
+
+class SmallDiamond(FastSearch):
+  """
+    Constructor:
+        cur_f: current frame
+        ref_f: reference frame
+        blk_sz: block size
+        wnd_size: search window size
+        metric: metric to compare the blocks distrotion
+    steps to the best of the 4 neighbors until the center wins
+    """
+
+  def __init__(self, cur_f, ref_f, blk_size, wnd_size, metric=MSE):
+    super(SmallDiamond, self).__init__(cur_f, ref_f, blk_size, wnd_size,
+                                       metric)
+    self.name = 'small diamond'
+
+  def search_blocks(self, rs, cs, mvs, costs, counts):
+    self.pattern_search(rs, cs, mvs, costs, counts, np.arange(len(rs)),
+                        SMALL_DIAMOND)
+
+
+"""Large Diamond Search"""
+
+
+class LargeDiamond(FastSearch):
+  """
+    Constructor:
+        cur_f: current frame
+        ref_f: reference frame
+        blk_sz: block size
+        wnd_size: search window size
+        metric: metric to compare the blocks distrotion
+    steps with the 8 point large diamond until the center wins, then checks
+    the small diamond once
+    """
+
+  def __init__(self, cur_f, ref_f, blk_size, wnd_size, metric=MSE):
+    super(LargeDiamond, self).__init__(cur_f, ref_f, blk_size, wnd_size,
+                                       metric)
+    self.name = 'large diamond'
+
+  def search_blocks(self, rs, cs, mvs, costs, counts):
+    sel = np.arange(len(rs))
+    self.pattern_search(rs, cs, mvs, costs, counts, sel, LARGE_DIAMOND)
+    self.step(rs, cs, mvs, costs, counts, sel, mvs[:, None] + SMALL_DIAMOND)
+
+
+"""Hexagon Search"""
+
+
+class Hexagon(FastSearch):
+  """
+    Constructor:
+        cur_f: current frame
+        ref_f: reference frame
+        blk_sz: block size
+        wnd_size: search window size
+        metric: metric to compare the blocks distrotion
+    steps with the 6 point hexagon until the center wins, then refines with
+    the small diamond, as vp9's hex search
+    """
+
+  def __init__(self, cur_f, ref_f, blk_size, wnd_size, metric=MSE):
+    super(Hexagon, self).__init__(cur_f, ref_f, blk_size, wnd_size, metric)
+    self.name = 'hexagon'
+
+  def search_blocks(self, rs, cs, mvs, costs, counts):
+    sel = np.arange(len(rs))
+    self.pattern_search(rs, cs, mvs, costs, counts, sel, HEXAGON)
+    self.pattern_search(rs, cs, mvs, costs, counts, sel, SMALL_DIAMOND)
+
+
+"""Predictor Seeded TZ Search"""
+
+
+class TZSearch(FastSearch):
+  """
+    Constructor:
+        cur_f: current frame
+        ref_f: reference frame
+        blk_sz: block size
+        wnd_size: search window size
+        raster: step of the raster scan, run when the best match of the
+                expanding diamond is farther than raster
+        metric: metric to compare the blocks distrotion
+    each block starts from the best of the zero vector and the vectors of its
+    left, top and top right neighbors, searches diamonds of radius 1, 2, 4 up
+    to the window size around it, and repeats the diamonds around the best
+    match until it stays in place
+    """
+
+  def __init__(self, cur_f, ref_f, blk_size, wnd_size, raster=5, metric=MSE):
+    self.raster = raster
+    super(TZSearch, self).__init__(cur_f, ref_f, blk_size, wnd_size, metric)
+    self.name = 'tz search'
+    #offsets of the expanding diamond and the radius each belongs to
+    rings = [SMALL_DIAMOND]
+    radius = [np.ones(len(SMALL_DIAMOND), dtype=int)]
+    d = 2
+    while d <= self.wnd_sz:
+      h = d // 2
+      rings.append(
+          np.array([[-d, 0], [-h, -h], [-h, h], [0, -d], [0, d], [h, -h],
+                    [h, h], [d, 0]]))
+      radius.append(np.full(8, d))
+      d *= 2
+    self.star = np.concatenate(rings)
+    self.star_radius = np.concatenate(radius)
+    grid = np.arange(-self.wnd_sz, self.wnd_sz, raster)
+    self.grid = np.stack(np.meshgrid(grid, grid, indexing='ij'),
+                         2).reshape(-1, 2)
+
+  """
+    expanding diamond around the selected blocks:
+    returns the radius at which each selected block found a better match, 0
+    if it stayed in place
+    """
+
+  def star_search(self, rs, cs, mvs, costs, counts, sel):
+    moved, best = self.step(rs, cs, mvs, costs, counts, sel,
+                            mvs[sel][:, None] + self.star)
+    dist = np.zeros(len(rs), dtype=int)
+    dist[moved] = self.star_radius[best]
+    return dist[sel]
+
+  def search_blocks(self, rs, cs, mvs, costs, counts):
+    sel = np.arange(len(rs))
+    dist = self.star_search(rs, cs, mvs, costs, counts, sel)
+    far = sel[dist > self.raster]
+    if len(far):
+      self.step(rs, cs, mvs, costs, counts, far,
+                np.repeat(self.grid[None], len(far), axis=0))
+    #refine around the best match until it stays in place
+    while len(sel):
+      sel = sel[self.star_search(rs, cs, mvs, costs, counts, sel) > 0]
+
+  def motion_field_estimation(self):
+    self.mf[:] = 0
+    self.block_evaluations = np.zeros((self.num_row, self.num_col), dtype=int)
+    self.clear_visited()
+    #a block waits for its left, top and top right neighbors, so the blocks
+    #with the same c + 2 * r are searched together
+    for t in xrange(self.num_col + 2 * (self.num_row - 1)):
+      rs = np.arange(max(0, (t - self.num_col + 2) // 2),
+                     min(self.num_row, t // 2 + 1))
+      cs = t - 2 * rs
+      preds = np.zeros((len(rs), 4, 2), dtype=int)
+      for k, (i, j) in enumerate(((0, -1), (-1, 0), (-1, 1))):
+        nb_r = rs + i
+        nb_c = cs + j
+        valid = (0 <= nb_r) & (0 <= nb_c) & (nb_c < self.num_col)
+        preds[valid, k + 1] = self.mf[nb_r[valid], nb_c[valid]]
+      #neighbors often share a vector, score each predictor once
+      same = np.all(preds[:, :, None] == preds[:, None], axis=3)
+      dup = np.any(np.tril(same, -1), axis=2)
+      mvs = np.zeros((len(rs), 2), dtype=int)
+      costs = np.full(len(rs), np.inf)
+      counts = np.zeros(len(rs), dtype=int)
+      self.step(rs, cs, mvs, costs, counts, np.arange(len(rs)), preds, dup)
+      self.search_blocks(rs, cs, mvs, costs, counts)
+      self.mf[rs, cs] = mvs
+      self.block_evaluations[rs, cs] = counts
+    self.evaluations = int(np.sum(self.block_evaluations))
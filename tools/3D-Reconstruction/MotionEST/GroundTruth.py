@@ -11,6 +11,7 @@
 import numpy as np
 import numpy.linalg as LA
 from MotionEST import MotionEST
+from MotionField import isField, loadField
 """Ground Truth:
 
   Load in ground truth motion field and mask
@@ -23,26 +24,44 @@ class GroundTruth(MotionEST):
     cur_f:current
     frame ref_f:reference
     frame blk_sz:block size
-    gt_path:ground truth motion field file path
+    gt_path:ground truth motion field file path, in the text format or a
+    motion field file
     """
 
   def __init__(self, cur_f, ref_f, blk_sz, gt_path, mf=None, mask=None):
     self.name = 'ground truth'
     super(GroundTruth, self).__init__(cur_f, ref_f, blk_sz)
     self.mask = np.zeros((self.num_row, self.num_col), dtype=bool)
-    if gt_path:
+    if gt_path and isField(gt_path):
+      #memory mapped, so large sets load without parsing
+      self.mf, mask, _ = loadField(gt_path)
+      if self.mf.shape[:2] != (self.num_row, self.num_col):
+        raise ValueError('ground truth field of shape %s does not match %dx%d '
+                         'blocks' % (self.mf.shape[:2], self.num_row,
+                                     self.num_col))
+      if mask is not None:
+        self.mask = mask
+    elif gt_path:
       with open(gt_path) as gt_file:
-        lines = gt_file.readlines()
-        for i in xrange(len(lines)):
-          info = lines[i].split(';')
-          for j in xrange(len(info)):
-            x, y = info[j].split(',')
-            #-, - stands for nothing
-            if x == '-' or y == '-':
-              self.mask[i, -j - 1] = True
-              continue
-            #the order of original file is flipped on the x axis
-            self.mf[i, -j - 1] = np.array([float(y), -float(x)], dtype=int)
+        lines = gt_file.read().splitlines()
+      #every line is a row of x,y cells separated by ';'
+      cells = np.char.count(np.array(lines, dtype=str), ';') + 1
+      if len(lines) != self.num_row or np.any(cells != self.num_col):
+        raise ValueError('ground truth %s does not have %d rows of %d cells' %
+                         (gt_path, self.num_row, self.num_col))
+      tokens = np.char.strip(
+          np.array(','.join(lines).replace(';', ',').split(','), dtype=str))
+      #the order of original file is flipped on the x axis
+      tokens = tokens.reshape(self.num_row, self.num_col, 2)[:, ::-1]
+      #-, - stands for nothing
+      self.mask = np.any(tokens == '-', axis=2)
+      xy = np.where(self.mask[:, :, None], '0', tokens).astype(float)
+      self.mf = np.trunc(np.stack([xy[:, :, 1], -xy[:, :, 0]], axis=2))
     else:
       self.mf = mf
       self.mask = mask
+
+  """save the ground truth with its mask to a motion field file"""
+
+  def save(self, path, mask=None):
+    super(GroundTruth, self).save(path, self.mask if mask is None else mask)
@@ -8,14 +8,23 @@
 ##
 
 # coding: utf-8
+import re
 import numpy as np
 import numpy.linalg as LA
+import scipy
 from scipy.ndimage.filters import gaussian_filter
 from scipy.sparse import csc_matrix
-from scipy.sparse.linalg import inv
+from scipy.sparse.linalg import cg, spsolve
 from MotionEST import MotionEST
+from Util import neighborAvg, NB8
 """Horn & Schunck Model"""
 
+#keyword of the conjugate gradient tolerance: rtol since scipy 1.12, which
+#deprecated tol, removed in 1.14
+_scipy_version = tuple(
+    int(v) for v in re.findall(r'\d+', scipy.__version__)[:2])
+CG_TOL = 'rtol' if _scipy_version >= (1, 12) else 'tol'
+
 
 class HornSchunck(MotionEST):
   """
@@ -29,11 +38,12 @@ class HornSchunck(MotionEST):
 
   def __init__(self, cur_f, ref_f, blk_sz, alpha, sigma, max_iter=100):
     super(HornSchunck, self).__init__(cur_f, ref_f, blk_sz)
-    self.cur_I, self.ref_I = self.getIntensity()
+    cur_I, ref_I = self.getIntensity()
     #perform gaussian blur to smooth the intensity
-    self.cur_I = gaussian_filter(self.cur_I, sigma=sigma)
-    self.ref_I = gaussian_filter(self.ref_I, sigma=sigma)
+    self.cur_I = gaussian_filter(cur_I, sigma=sigma)
+    self.ref_I = gaussian_filter(ref_I, sigma=sigma)
     self.alpha = alpha
+    self.sigma = sigma
     self.max_iter = max_iter
     self.Ix, self.Iy, self.It = self.intensityDiff()
 
@@ -42,18 +52,11 @@ class HornSchunck(MotionEST):
     """
 
   def getIntensity(self):
-    cur_I = np.zeros((self.num_row, self.num_col))
-    ref_I = np.zeros((self.num_row, self.num_col))
+    m, n, sz = self.num_row, self.num_col, self.blk_sz
     #use average intensity as block's intensity
-    for i in xrange(self.num_row):
-      for j in xrange(self.num_col):
-        r = i * self.blk_sz
-        c = j * self.blk_sz
-        cur_I[i, j] = np.mean(self.cur_yuv[r:r + self.blk_sz, c:c + self.blk_sz,
-                                           0])
-        ref_I[i, j] = np.mean(self.ref_yuv[r:r + self.blk_sz, c:c + self.blk_sz,
-                                           0])
-    return cur_I, ref_I
+    cur_I = self.cur_yuv[:m * sz, :n * sz, 0].reshape(m, sz, n, sz)
+    ref_I = self.ref_yuv[:m * sz, :n * sz, 0].reshape(m, sz, n, sz)
+    return cur_I.mean(axis=(1, 3)), ref_I.mean(axis=(1, 3))
 
   """
     Get First Order Derivative
@@ -63,45 +66,25 @@ class HornSchunck(MotionEST):
     Ix = np.zeros((self.num_row, self.num_col))
     Iy = np.zeros((self.num_row, self.num_col))
     It = np.zeros((self.num_row, self.num_col))
-    sz = self.blk_sz
-    for i in xrange(self.num_row - 1):
-      for j in xrange(self.num_col - 1):
+    """
+        Ix:
+        (i  ,j) <--- (i  ,j+1)
+        (i+1,j) <--- (i+1,j+1)
         """
-                Ix:
-                (i  ,j) <--- (i  ,j+1)
-                (i+1,j) <--- (i+1,j+1)
-                """
-        count = 0
-        for r, c in {(i, j + 1), (i + 1, j + 1)}:
-          if 0 <= r < self.num_row and 0 < c < self.num_col:
-            Ix[i, j] += (
-                self.cur_I[r, c] - self.cur_I[r, c - 1] + self.ref_I[r, c] -
-                self.ref_I[r, c - 1])
-            count += 2
-        Ix[i, j] /= count
+    dx = np.diff(self.cur_I, axis=1) + np.diff(self.ref_I, axis=1)
+    Ix[:-1, :-1] = (dx[:-1] + dx[1:]) / 4
+    """
+        Iy:
+        (i  ,j)      (i  ,j+1)
+           ^             ^
+           |             |
+        (i+1,j)      (i+1,j+1)
         """
-                Iy:
-                (i  ,j)      (i  ,j+1)
-                   ^             ^
-                   |             |
-                (i+1,j)      (i+1,j+1)
-                """
-        count = 0
-        for r, c in {(i + 1, j), (i + 1, j + 1)}:
-          if 0 < r < self.num_row and 0 <= c < self.num_col:
-            Iy[i, j] += (
-                self.cur_I[r, c] - self.cur_I[r - 1, c] + self.ref_I[r, c] -
-                self.ref_I[r - 1, c])
-            count += 2
-        Iy[i, j] /= count
-        count = 0
-        #It:
-        for r in xrange(i, i + 2):
-          for c in xrange(j, j + 2):
-            if 0 <= r < self.num_row and 0 <= c < self.num_col:
-              It[i, j] += (self.ref_I[r, c] - self.cur_I[r, c])
-              count += 1
-        It[i, j] /= count
+    dy = np.diff(self.cur_I, axis=0) + np.diff(self.ref_I, axis=0)
+    Iy[:-1, :-1] = (dy[:, :-1] + dy[:, 1:]) / 4
+    #It:
+    dt = self.ref_I - self.cur_I
+    It[:-1, :-1] = (dt[:-1, :-1] + dt[:-1, 1:] + dt[1:, :-1] + dt[1:, 1:]) / 4
     return Ix, Iy, It
 
   """
@@ -110,7 +93,6 @@ class HornSchunck(MotionEST):
     """
 
   def averageMV(self):
-    avg = np.zeros((self.num_row, self.num_col, 2))
     """
         1/12 ---  1/6 --- 1/12
          |         |       |
@@ -118,15 +100,7 @@ class HornSchunck(MotionEST):
          |         |       |
         1/12 ---  1/6 --- 1/12
         """
-    for i in xrange(self.num_row):
-      for j in xrange(self.num_col):
-        for r, c in {(-1, 0), (1, 0), (0, -1), (0, 1)}:
-          if 0 <= i + r < self.num_row and 0 <= j + c < self.num_col:
-            avg[i, j] += self.mf[i + r, j + c] / 6.0
-        for r, c in {(-1, -1), (-1, 1), (1, -1), (1, 1)}:
-          if 0 <= i + r < self.num_row and 0 <= j + c < self.num_col:
-            avg[i, j] += self.mf[i + r, j + c] / 12.0
-    return avg
+    return neighborAvg(self.mf, NB8)
 
   def motion_field_estimation(self):
     count = 0
@@ -144,69 +118,62 @@ class HornSchunck(MotionEST):
       count += 1
     self.mf *= self.blk_sz
 
-  def motion_field_estimation_mat(self):
-    row_idx = []
-    col_idx = []
-    data = []
-
-    N = 2 * self.num_row * self.num_col
-    b = np.zeros((N, 1))
-    for i in xrange(self.num_row):
-      for j in xrange(self.num_col):
-        """(IxIx+alpha^2)u+IxIy.v-alpha^2~u IxIy.u+(IyIy+alpha^2)v-alpha^2~v"""
-        u_idx = i * 2 * self.num_col + 2 * j
-        v_idx = u_idx + 1
-        b[u_idx, 0] = -self.Ix[i, j] * self.It[i, j]
-        b[v_idx, 0] = -self.Iy[i, j] * self.It[i, j]
-        #u: (IxIx+alpha^2)u
-        row_idx.append(u_idx)
-        col_idx.append(u_idx)
-        data.append(self.Ix[i, j] * self.Ix[i, j] + self.alpha**2)
-        #IxIy.v
-        row_idx.append(u_idx)
-        col_idx.append(v_idx)
-        data.append(self.Ix[i, j] * self.Iy[i, j])
-
-        #v: IxIy.u
-        row_idx.append(v_idx)
-        col_idx.append(u_idx)
-        data.append(self.Ix[i, j] * self.Iy[i, j])
-        #(IyIy+alpha^2)v
-        row_idx.append(v_idx)
-        col_idx.append(v_idx)
-        data.append(self.Iy[i, j] * self.Iy[i, j] + self.alpha**2)
-
-        #-alpha^2~u
-        #-alpha^2~v
-        for r, c in {(-1, 0), (1, 0), (0, -1), (0, 1)}:
-          if 0 <= i + r < self.num_row and 0 <= j + c < self.num_col:
-            u_nb = (i + r) * 2 * self.num_col + 2 * (j + c)
-            v_nb = u_nb + 1
-
-            row_idx.append(u_idx)
-            col_idx.append(u_nb)
-            data.append(-1 * self.alpha**2 / 6.0)
-
-            row_idx.append(v_idx)
-            col_idx.append(v_nb)
-            data.append(-1 * self.alpha**2 / 6.0)
-        for r, c in {(-1, -1), (-1, 1), (1, -1), (1, 1)}:
-          if 0 <= i + r < self.num_row and 0 <= j + c < self.num_col:
-            u_nb = (i + r) * 2 * self.num_col + 2 * (j + c)
-            v_nb = u_nb + 1
-
-            row_idx.append(u_idx)
-            col_idx.append(u_nb)
-            data.append(-1 * self.alpha**2 / 12.0)
-
-            row_idx.append(v_idx)
-            col_idx.append(v_nb)
-            data.append(-1 * self.alpha**2 / 12.0)
-    M = csc_matrix((data, (row_idx, col_idx)), shape=(N, N))
-    M_inv = inv(M)
-    uv = M_inv.dot(b)
+  """
+    solve the Horn & Schunck equations as one sparse linear system:
+      solver: 'direct' for a sparse LU solve, 'cg' for conjugate gradient
+              with a block Jacobi preconditioner, warm started from the
+              current motion field
+      tol: relative tolerance of the conjugate gradient
+    """
 
-    for i in xrange(self.num_row):
-      for j in xrange(self.num_col):
-        self.mf[i, j, 0] = uv[i * 2 * self.num_col + 2 * j + 1, 0] * self.blk_sz
-        self.mf[i, j, 1] = uv[i * 2 * self.num_col + 2 * j, 0] * self.blk_sz
+  def motion_field_estimation_mat(self, solver='direct', tol=1e-8):
+    """(IxIx+alpha^2)u+IxIy.v-alpha^2~u IxIy.u+(IyIy+alpha^2)v-alpha^2~v"""
+    m, n = self.num_row, self.num_col
+    N = 2 * m * n
+    a2 = self.alpha**2
+    Ix, Iy, It = self.Ix.ravel(), self.Iy.ravel(), self.It.ravel()
+    #unknowns are interleaved as u (column shift), v (row shift) per block
+    u_idx = 2 * np.arange(m * n).reshape(m, n)
+    v_idx = u_idx + 1
+    b = np.empty(N)
+    b[0::2] = -Ix * It
+    b[1::2] = -Iy * It
+    #per block 2x2 system: [[IxIx+alpha^2, IxIy], [IxIy, IyIy+alpha^2]]
+    row_idx = [u_idx.ravel(), u_idx.ravel(), v_idx.ravel(), v_idx.ravel()]
+    col_idx = [u_idx.ravel(), v_idx.ravel(), u_idx.ravel(), v_idx.ravel()]
+    data = [Ix * Ix + a2, Ix * Iy, Ix * Iy, Iy * Iy + a2]
+    #-alpha^2~u and -alpha^2~v
+    weights = -a2 * NB8
+    for r in xrange(-1, 2):
+      for c in xrange(-1, 2):
+        if r == 0 and c == 0:
+          continue
+        rows = slice(max(0, -r), m - max(0, r))
+        cols = slice(max(0, -c), n - max(0, c))
+        nb_rows = slice(max(0, r), m + min(0, r))
+        nb_cols = slice(max(0, c), n + min(0, c))
+        for idx in (u_idx, v_idx):
+          row_idx.append(idx[rows, cols].ravel())
+          col_idx.append(idx[nb_rows, nb_cols].ravel())
+          data.append(np.full(row_idx[-1].size, weights[r + 1, c + 1]))
+    M = csc_matrix(
+        (np.concatenate(data), (np.concatenate(row_idx),
+                                np.concatenate(col_idx))),
+        shape=(N, N))
+    if solver == 'cg':
+      #invert the per block 2x2 systems as the preconditioner
+      det = (Ix * Ix + a2) * (Iy * Iy + a2) - (Ix * Iy)**2
+      inv_data = [Iy * Iy + a2, -Ix * Iy, -Ix * Iy, Ix * Ix + a2]
+      P = csc_matrix(
+          (np.concatenate(inv_data) / np.tile(det, 4),
+           (np.concatenate(row_idx[:4]), np.concatenate(col_idx[:4]))),
+          shape=(N, N))
+      x0 = self.mf[:, :, ::-1].ravel() / self.blk_sz
+      uv, info = cg(M, b, x0=x0, M=P, **{CG_TOL: tol})
+      if info > 0:
+        raise RuntimeError('conjugate gradient did not converge in %d '
+                           'iterations' % info)
+    else:
+      uv = spsolve(M, b)
+    self.mf[:, :, 0] = uv[1::2].reshape(m, n) * self.blk_sz
+    self.mf[:, :, 1] = uv[0::2].reshape(m, n) * self.blk_sz
@@ -0,0 +1,96 @@
+##  Copyright (c) 2020 The WebM project authors. All Rights Reserved.
+##
+##  Use of this source code is governed by a BSD-style license
+##  that can be found in the LICENSE file in the root of the source
+##  tree. An additional intellectual property rights grant can be found
+##  in the file PATENTS.  All contributing project authors may
+##  be found in the AUTHORS file in the root of the source tree.
+##
+
+# coding: utf-8
+import threading
+import numpy as np
+"""Block Metrics:
+
+  luma-only distortion kernels with the same convention as Util.MSE: blocks
+  of shape (..., h, w, channels), or batches of them, are reduced over the
+  trailing (h, w, channels) axes. only channel 0 is compared, uint8 samples
+  are used as they are and the distortion is accumulated in int32, which
+  holds blocks up to 64x64
+"""
+
+#scratch buffers reused across calls, grown to the largest batch seen. each
+#thread has its own, so the metrics are safe to call from a thread pool
+_scratch = threading.local()
+
+
+def _buffer(name, shape):
+  size = int(np.prod(shape))
+  buf = getattr(_scratch, name, None)
+  if buf is None or buf.size < size:
+    buf = np.empty(size, dtype=np.int32)
+    setattr(_scratch, name, buf)
+  return buf[:size].reshape(shape)
+
+
+#luma differences of two (batches of) blocks in a scratch buffer
+def _diff(blk1, blk2):
+  y1 = np.asarray(blk1)[..., 0]
+  y2 = np.asarray(blk2)[..., 0]
+  diff = _buffer('diff', np.broadcast(y1, y2).shape)
+  np.subtract(y1, y2, out=diff, dtype=np.int32, casting='unsafe')
+  return diff
+
+
+"""
+  sum of absolute differences
+"""
+
+
+def SAD(blk1, blk2):
+  diff = _diff(blk1, blk2)
+  np.abs(diff, out=diff)
+  return diff.sum(axis=(-2, -1), dtype=np.int32)
+
+
+"""
+  sum of squared differences
+"""
+
+
+def SSE(blk1, blk2):
+  diff = _diff(blk1, blk2)
+  np.multiply(diff, diff, out=diff)
+  return diff.sum(axis=(-2, -1), dtype=np.int32)
+
+
+#unnormalized Hadamard matrices, in Sylvester order
+_H4 = np.array([[1, 1, 1, 1], [1, -1, 1, -1], [1, 1, -1, -1], [1, -1, -1, 1]],
+               dtype=np.int32)
+HADAMARD = {
+    4: _H4,
+    8: np.kron(np.array([[1, 1], [1, -1]]), _H4).astype(np.int32)
+}
+"""
+  sum of absolute transformed differences: the differences are Hadamard
+  transformed in 8x8 sub-blocks (4x4 when the block size is not a multiple
+  of 8) and the absolute coefficients summed, as vpx_hadamard_8x8 followed
+  by vpx_satd
+"""
+
+
+def SATD(blk1, blk2):
+  diff = _diff(blk1, blk2)
+  h, w = diff.shape[-2:]
+  n = 8 if h % 8 == 0 and w % 8 == 0 else 4
+  if h % n or w % n:
+    raise ValueError('SATD needs blocks of a multiple of 4, got %dx%d' % (h, w))
+  H = HADAMARD[n]
+  #(..., h / n, w / n, n, n) view of the sub-blocks
+  sub = diff.reshape(diff.shape[:-2] + (h // n, n, w // n, n)).swapaxes(-3, -2)
+  rows = _buffer('rows', sub.shape)
+  coeff = _buffer('coeff', sub.shape)
+  np.matmul(H, sub, out=rows)
+  np.matmul(rows, H, out=coeff)
+  np.abs(coeff, out=coeff)
+  return coeff.sum(axis=(-4, -3, -2, -1), dtype=np.int32)
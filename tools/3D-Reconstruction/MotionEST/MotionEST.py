@@ -8,12 +8,53 @@
 ##
 
 #coding : utf - 8
+import contextlib
+import hashlib
+import multiprocessing
+import numbers
+import os
+import time
 import numpy as np
 import numpy.linalg as LA
 import matplotlib.pyplot as plt
-from Util import drawMF, MSE
+from collections import OrderedDict
+from numpy.lib.stride_tricks import as_strided
+from PIL import Image
+from Util import drawMF, toYUV, errorStats, MSE
+from MotionField import loadField, saveField
 """The Base Class of Estimators"""
 
+#estimator whose tiles are being run, inherited by the forked tile workers,
+#and the pool of those workers
+_tile_est = None
+_tile_pool = None
+
+
+def _run_tile(args):
+  task, r0, r1, task_args = args
+  return getattr(_tile_est, task)(r0, r1, *task_args)
+
+
+#arrays derived from frames, shared by all the estimators, least recently
+#used first, and the bytes they hold. CACHE_BUDGET bounds the bytes
+_cache = OrderedDict()
+_cache_bytes = 0
+CACHE_BUDGET = 256 << 20
+
+
+def _contentKey(arrays):
+  key = hashlib.md5()
+  for a in arrays:
+    a = np.ascontiguousarray(a)
+    key.update(('%s%s' % (a.dtype, a.shape)).encode('ascii'))
+    key.update(a.data)
+  return key.hexdigest()
+
+
+#arrays of a cached value, which may be an array or a tuple or list of them
+def _arrays(value):
+  return value if isinstance(value, (tuple, list)) else [value]
+
 
 class MotionEST(object):
   """
@@ -21,23 +62,76 @@ class MotionEST(object):
         cur_f: current frame
         ref_f: reference frame
         blk_sz: block size
+    frames are PIL images, YCbCr arrays or raw planes, see Util.toYUV. a
+    uint8 luma plane is used without copying, as a luma-only frame
     """
 
+  #attributes that change while estimating or do not change the field,
+  #left out of settings
+  state = ('name', 'workers', 'evaluations')
+
   def __init__(self, cur_f, ref_f, blk_sz):
     self.cur_f = cur_f
     self.ref_f = ref_f
     self.blk_sz = blk_sz
     #convert RGB to YUV
-    self.cur_yuv = np.array(self.cur_f.convert('YCbCr'), dtype=int)
-    self.ref_yuv = np.array(self.ref_f.convert('YCbCr'), dtype=int)
+    self.cur_yuv = self.convert(self.cur_f)
+    self.ref_yuv = self.convert(self.ref_f)
     #frame size
-    self.width = self.cur_f.size[0]
-    self.height = self.cur_f.size[1]
+    self.height, self.width = self.cur_yuv.shape[:2]
     #motion field size
     self.num_row = self.height // self.blk_sz
     self.num_col = self.width // self.blk_sz
     #initialize motion field
     self.mf = np.zeros((self.num_row, self.num_col, 2))
+    #number of worker processes used by tile_map, 1 runs serially
+    self.workers = 1
+    #block distortion evaluations of the last estimation, None if not counted
+    self.evaluations = None
+
+  """
+    look up an array derived from frames in the shared cache:
+      kind: name of what is derived
+      arrays: frames (or other arrays) it is derived from, keyed by content
+      params: hashable parameters of the derivation
+      build: function computing the value on a miss
+    the value, an array or a list of arrays, is returned read-only and
+    shared with every estimator asking for the same derivation of the same
+    content. the least recently used values are dropped to keep the cache
+    within CACHE_BUDGET bytes
+  """
+
+  def cached(self, kind, arrays, params, build):
+    global _cache_bytes
+    key = (kind, _contentKey(arrays), params)
+    if key in _cache:
+      value = _cache.pop(key)
+    else:
+      value = build()
+      for a in _arrays(value):
+        a.flags.writeable = False
+      _cache_bytes += sum(a.nbytes for a in _arrays(value))
+    _cache[key] = value
+    #the budget may have been lowered since the last call
+    while _cache_bytes > CACHE_BUDGET:
+      _, old = _cache.popitem(last=False)
+      _cache_bytes -= sum(a.nbytes for a in _arrays(old))
+    return value
+
+  """
+    convert a frame with Util.toYUV, PIL images through the cache so that
+    estimators on the same frames convert them once. the samples of palette
+    images are indices, their palette is part of the key
+  """
+
+  def convert(self, f):
+    if not hasattr(f, 'convert'):
+      return toYUV(f)
+    arrays = [np.asarray(f)]
+    palette = f.getpalette()
+    if palette is not None:
+      arrays.append(np.array(palette))
+    return self.cached('yuv', arrays, f.mode, lambda: toYUV(f))
 
   """estimation function Override by child classes"""
 
@@ -63,47 +157,253 @@ class MotionEST(object):
     if 0 <= ref_x < self.width - w and 0 <= ref_y < self.height - h:
       ref_blk = self.ref_yuv[ref_y:ref_y + h, ref_x:ref_x + w, :]
     else:
-      ref_blk = np.zeros((h, w, 3))
+      ref_blk = np.zeros((h, w, self.ref_yuv.shape[2]))
     return metric(cur_blk, ref_blk)
 
+  """
+    distortion of every block, each with its own motion vector:
+      mvs: motion field of shape (num_row, num_col, 2)
+      metric: distortion metric
+    matches block_dist for every block in a single batched metric call
+  """
+
+  def field_dist(self, mvs, metric=MSE):
+    blk_sz = self.blk_sz
+    cur_y = np.arange(self.num_row)[:, None] * blk_sz
+    cur_x = np.arange(self.num_col)[None, :] * blk_sz
+    ref_y = (cur_y + mvs[:, :, 0]).astype(int)
+    ref_x = (cur_x + mvs[:, :, 1]).astype(int)
+    valid = (0 <= ref_x) & (ref_x < self.width - blk_sz) & (0 <= ref_y) & (
+        ref_y < self.height - blk_sz)
+    ref_y = np.where(valid, ref_y, 0)[:, :, None, None]
+    ref_x = np.where(valid, ref_x, 0)[:, :, None, None]
+    offset = np.arange(blk_sz)
+    ref_blks = self.ref_yuv[ref_y + offset[:, None], ref_x + offset[None, :]]
+    ref_blks[~valid] = 0
+    return metric(self.block_view(self.cur_yuv), ref_blks)
+
+  """
+    view a frame as the grid of blocks without copying:
+      yuv: frame (or padded frame) to split
+      y: row of the top left corner of the grid
+      x: column of the top left corner of the grid
+      rows: number of block rows, num_row by default
+    returns an array of shape (rows, num_col, blk_sz, blk_sz, channels)
+  """
+
+  def block_view(self, yuv, y=0, x=0, rows=None):
+    rows = self.num_row if rows is None else rows
+    yuv = np.ascontiguousarray(yuv)
+    s0, s1, s2 = yuv.strides
+    return as_strided(
+        yuv[y:, x:],
+        shape=(rows, self.num_col, self.blk_sz, self.blk_sz, yuv.shape[2]),
+        strides=(self.blk_sz * s0, self.blk_sz * s1, s0, s1, s2),
+        writeable=False)
+
+  """
+    context in which every tile_map of this estimator runs on the same pool
+    of forked workers, so that an estimation mapping several tasks, such as
+    one per pyramid level, forks once. the workers see the estimator as it
+    is when the context is entered: the tasks may only read the state set
+    before, anything computed later has to be passed as arguments
+  """
+
+  @contextlib.contextmanager
+  def tile_pool(self):
+    global _tile_est, _tile_pool
+    workers = min(self.workers, self.num_row)
+    if workers <= 1 or not hasattr(os, 'fork') or _tile_est is self:
+      yield
+      return
+    #a nested estimator forks its own pool, the outer one is restored after
+    outer = _tile_est, _tile_pool
+    _tile_est = self
+    try:
+      if hasattr(multiprocessing, 'get_context'):
+        _tile_pool = multiprocessing.get_context('fork').Pool(workers)
+      else:
+        _tile_pool = multiprocessing.Pool(workers)
+      try:
+        yield
+      finally:
+        _tile_pool.close()
+        _tile_pool.join()
+    finally:
+      _tile_est, _tile_pool = outer
+
+  """
+    run a task over bands of block rows:
+      task: name of a method taking (r0, r1, *args) and returning the results
+            of block rows [r0, r1) stacked along the first axis, or a tuple
+            of such arrays
+      args: extra arguments passed to every band
+    with more than one worker the bands run in forked processes, which share
+    the frames with this process copy on write instead of pickling them, on
+    the pool of the enclosing tile_pool or on one forked for this call
+  """
+
+  def tile_map(self, task, *args):
+    workers = min(self.workers, self.num_row)
+    if workers <= 1 or not hasattr(os, 'fork'):
+      return getattr(self, task)(0, self.num_row, *args)
+    if _tile_est is not self:
+      with self.tile_pool():
+        return self.tile_map(task, *args)
+    #a few bands per worker to balance uneven rows
+    bounds = np.linspace(0, self.num_row,
+                         min(self.num_row, 4 * workers) + 1).astype(int)
+    tiles = [(task, r0, r1, args) for r0, r1 in zip(bounds[:-1], bounds[1:])]
+    results = _tile_pool.map(_run_tile, tiles)
+    if isinstance(results[0], tuple):
+      return tuple(np.concatenate(res) for res in zip(*results))
+    return np.concatenate(results)
+
+  """
+    distortion of every block under the motion field:
+      metric: distortion metric
+    returns a (num_row, num_col) map, the motion compensated MSE by default
+  """
+
+  def distortion_map(self, metric=MSE):
+    return self.field_dist(self.mf, metric)
+
   """
     distortion of motion field
   """
 
   def distortion(self, mask=None, metric=MSE):
-    loss = 0
-    count = 0
-    for i in xrange(self.num_row):
-      for j in xrange(self.num_col):
-        if mask is not None and mask[i, j]:
-          continue
-        loss += self.block_dist(i, j, self.mf[i, j], metric)
-        count += 1
-    return loss / count
+    loss = self.distortion_map(metric)
+    if mask is not None:
+      loss = loss[~np.asarray(mask, dtype=bool)]
+    return np.mean(loss)
+
+  """
+    endpoint error of every block against the ground truth:
+      ground_truth: GroundTruth estimator
+    returns a (num_row, num_col) map of the length of the difference of the
+    motion vectors
+  """
+
+  def endpoint_error(self, ground_truth):
+    return LA.norm(ground_truth.mf - self.mf, axis=2)
+
+  """
+    angular error of every block against the ground truth:
+      ground_truth: GroundTruth estimator
+    returns a (num_row, num_col) map of the angle in degrees between the
+    space time directions (u, v, 1) of the estimated and the true motion
+  """
+
+  def angular_error(self, ground_truth):
+    #fields loaded from a motion field file may be int16, which the squares
+    #would overflow
+    gt = np.asarray(ground_truth.mf, dtype=float)
+    mf = np.asarray(self.mf, dtype=float)
+    dot = 1 + np.sum(gt * mf, axis=2)
+    norm = np.sqrt((1 + np.sum(np.square(gt), axis=2)) *
+                   (1 + np.sum(np.square(mf), axis=2)))
+    return np.degrees(np.arccos(np.clip(dot / norm, -1, 1)))
 
   """evaluation compare the difference with ground truth"""
 
   def motion_field_evaluation(self, ground_truth):
-    loss = 0
-    count = 0
-    gt = ground_truth.mf
-    mask = ground_truth.mask
-    for i in xrange(self.num_row):
-      for j in xrange(self.num_col):
-        if mask is not None and mask[i][j]:
-          continue
-        loss += LA.norm(gt[i, j] - self.mf[i, j])
-        count += 1
-    return loss / count
+    return errorStats(self.endpoint_error(ground_truth),
+                      ground_truth.mask)['mean']
+
+  """
+    time the motion field estimation:
+      ground_truth: GroundTruth estimator to report the endpoint error
+                    against, None to skip it
+    returns a dict of the name, the time in seconds, the block distortion
+    evaluations per block when counted and the endpoint error statistics of
+    Util.errorStats keyed 'epe_mean', 'epe_p90' etc, see Util.profileTable
+  """
+
+  def profile(self, ground_truth=None):
+    start = time.time()
+    self.motion_field_estimation()
+    report = {
+        'name': getattr(self, 'name', type(self).__name__),
+        'time': time.time() - start
+    }
+    if self.evaluations is not None:
+      report['evals'] = float(self.evaluations) / (self.num_row * self.num_col)
+    if ground_truth is not None:
+      stats = errorStats(self.endpoint_error(ground_truth), ground_truth.mask)
+      for k, v in stats.items():
+        report['epe_' + k] = v
+    return report
+
+  """
+    save the motion field to a motion field file:
+      path: file path
+      mask: blocks without motion vector, None for none
+  """
+
+  def save(self, path, mask=None):
+    saveField(path, self.mf, mask, self.blk_sz, self.height, self.width)
+
+  """
+    settings of the estimator: its class and its parameters, the scalar
+    attributes but the ones in state, metrics by name and nested estimators
+    by their own settings
+  """
+
+  def settings(self):
+    params = []
+    for k, v in sorted(vars(self).items()):
+      if k in self.state:
+        continue
+      if isinstance(v, MotionEST):
+        params.append('%s=%s' % (k, v.settings()))
+      elif isinstance(v, (numbers.Number, str)):
+        params.append('%s=%r' % (k, v))
+      elif callable(v):
+        params.append('%s=%s' % (k, v.__name__))
+    return '%s(%s)' % (type(self).__name__, ', '.join(params))
+
+  """
+    estimate the motion field, cached on disk between runs:
+      path: motion field file of the cache
+    the field saved at path is loaded instead of estimating when it was made
+    from the same frames, by content, with the same block and frame size and
+    the same settings. otherwise it is estimated and saved at path, fields
+    with fractional vectors as float32
+  """
+
+  def cached_estimation(self, path):
+    meta = {
+        'blk_sz': self.blk_sz,
+        'height': self.height,
+        'width': self.width,
+        'frames': _contentKey([self.cur_yuv, self.ref_yuv]),
+        'settings': hashlib.md5(self.settings().encode('utf-8')).hexdigest()
+    }
+    if os.path.exists(path):
+      mf, _, saved = loadField(path)
+      if mf.shape == self.mf.shape and saved == meta:
+        self.mf = np.array(mf, dtype=float)
+        return
+    self.motion_field_estimation()
+    saveField(path, self.mf, None, self.blk_sz, self.height, self.width,
+              meta['frames'], meta['settings'])
 
   """render the motion field"""
 
   def show(self, ground_truth=None, size=10):
-    cur_mf = drawMF(self.cur_f, self.blk_sz, self.mf)
+    cur_f = self.cur_f
+    if not hasattr(cur_f, 'convert'):
+      if self.cur_yuv.shape[2] == 1:
+        cur_f = Image.fromarray(self.cur_yuv[:, :, 0].astype(np.uint8), 'L')
+      else:
+        cur_f = Image.fromarray(self.cur_yuv.astype(np.uint8), 'YCbCr')
+      cur_f = cur_f.convert('RGB')
+    cur_mf = drawMF(cur_f, self.blk_sz, self.mf)
     if ground_truth is None:
       n_row = 1
     else:
-      gt_mf = drawMF(self.cur_f, self.blk_sz, ground_truth)
+      gt_mf = drawMF(cur_f, self.blk_sz, ground_truth)
       n_row = 2
     plt.figure(figsize=(n_row * size, size * self.height / self.width))
     plt.subplot(1, n_row, 1)
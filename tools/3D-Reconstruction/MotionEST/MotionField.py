@@ -0,0 +1,108 @@
+##  Copyright (c) 2020 The WebM project authors. All Rights Reserved.
+##
+##  Use of this source code is governed by a BSD-style license
+##  that can be found in the LICENSE file in the root of the source
+##  tree. An additional intellectual property rights grant can be found
+##  in the file PATENTS.  All contributing project authors may
+##  be found in the AUTHORS file in the root of the source tree.
+##
+
+# coding: utf-8
+import binascii
+import struct
+import numpy as np
+"""Motion Field File:
+
+  binary container of a motion field. a 64 byte header is followed by the
+  motion vectors, (num_row, num_col, 2) little endian int16 or float32, and
+  by the mask packed 8 blocks per byte, when there is one
+"""
+
+MAGIC = b'MVF1'
+#magic, dtype code, has mask, block size, num_row, num_col, height, width,
+#md5 digests of the frames and of the estimator settings
+HEADER = struct.Struct('<4sBBxxIIIII16s16sxxxx')
+DTYPES = [np.dtype('<i2'), np.dtype('<f4')]
+"""
+  check whether a file is a motion field file:
+    path: file path
+"""
+
+
+def isField(path):
+  with open(path, 'rb') as f:
+    return f.read(len(MAGIC)) == MAGIC
+
+
+"""
+  save a motion field:
+    path: file path
+    mf: motion field of shape (num_row, num_col, 2)
+    mask: blocks without motion vector, None for none
+    blk_sz, height, width: block and frame size the field belongs to
+    frames, settings: hex md5 digests identifying the frames and the
+                      estimator the field was made from, zeros when empty
+  the vectors are stored as int16 when they are all whole numbers in range,
+  as float32 otherwise
+"""
+
+
+def saveField(path, mf, mask, blk_sz, height, width, frames='', settings=''):
+  mf = np.asarray(mf)
+  num_row, num_col = mf.shape[:2]
+  int16 = np.iinfo(np.int16)
+  whole = np.all(np.round(mf) == mf) and np.all(
+      (int16.min <= mf) & (mf <= int16.max))
+  code = 0 if whole else 1
+  with open(path, 'wb') as f:
+    f.write(
+        HEADER.pack(MAGIC, code, mask is not None, blk_sz, num_row, num_col,
+                    height, width, binascii.unhexlify(frames),
+                    binascii.unhexlify(settings)))
+    f.write(np.ascontiguousarray(mf, dtype=DTYPES[code]).tobytes())
+    if mask is not None:
+      f.write(np.packbits(np.asarray(mask, dtype=bool)).tobytes())
+
+
+"""
+  load a motion field saved by saveField:
+    path: file path
+  returns the motion field as a read-only memmap of the file, the mask
+  (None if the file has none) and a dict of blk_sz, height, width, frames
+  and settings, the last two as hex digests
+"""
+
+
+def loadField(path):
+  with open(path, 'rb') as f:
+    header = f.read(HEADER.size)
+  if len(header) < HEADER.size:
+    raise ValueError('truncated motion field file: ' + path)
+  magic, code, has_mask, blk_sz, num_row, num_col, height, width, frames, \
+      settings = HEADER.unpack(header)
+  if magic != MAGIC or code >= len(DTYPES):
+    raise ValueError('not a motion field file: ' + path)
+  mf = np.memmap(
+      path,
+      dtype=DTYPES[code],
+      mode='r',
+      offset=HEADER.size,
+      shape=(num_row, num_col, 2))
+  mask = None
+  if has_mask:
+    offset = HEADER.size + mf.nbytes
+    bits = np.memmap(
+        path,
+        dtype=np.uint8,
+        mode='r',
+        offset=offset,
+        shape=((num_row * num_col + 7) // 8,))
+    mask = np.unpackbits(bits)[:num_row * num_col].reshape(num_row,
+                                                          num_col).astype(bool)
+  return mf, mask, {
+      'blk_sz': blk_sz,
+      'height': height,
+      'width': width,
+      'frames': binascii.hexlify(frames).decode('ascii'),
+      'settings': binascii.hexlify(settings).decode('ascii')
+  }
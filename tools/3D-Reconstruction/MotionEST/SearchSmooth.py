@@ -10,102 +10,118 @@
 # coding: utf-8
 import numpy as np
 import numpy.linalg as LA
-from Util import MSE
+from Util import MSE, neighborAvg, NB8
 from MotionEST import MotionEST
-"""Search & Smooth Model with Adapt Weights"""
+"""Search & Smooth Models:
+
+  smooth the motion field of a block matching estimator
+"""
 
 
-class SearchSmoothAdapt(MotionEST):
+class SearchSmooth(MotionEST):
   """
     Constructor:
         cur_f: current frame
         ref_f: reference frame
         blk_sz: block size
-        wnd_size: search window size
-        beta: neigbor loss weight
-        max_iter: maximum number of iterations
-        metric: metric to compare the blocks distrotion
+        search: block matching estimator
     """
 
-  def __init__(self, cur_f, ref_f, blk_size, search, max_iter=100):
+  def __init__(self, cur_f, ref_f, blk_size, search):
     self.search = search
-    self.max_iter = max_iter
-    super(SearchSmoothAdapt, self).__init__(cur_f, ref_f, blk_size)
+    super(SearchSmooth, self).__init__(cur_f, ref_f, blk_size)
 
   """
-    get local diffiencial of refernce
+    get local diffiencial of refernce:
+      mvs: block matching results
+    returns an array of shape (num_row, num_col, 2, 2) holding the outer
+    product of each block's (I_row, I_col) with itself, shared by every model
+    smoothing the same matching results of the same frames
     """
 
   def getRefLocalDiff(self, mvs):
-    m, n = self.num_row, self.num_col
-    localDiff = [[] for _ in xrange(m)]
-    blk_sz = self.blk_sz
-    for r in xrange(m):
-      for c in xrange(n):
-        I_row = 0
-        I_col = 0
-        #get ssd surface
-        count = 0
-        center = self.cur_yuv[r * blk_sz:(r + 1) * blk_sz,
-                              c * blk_sz:(c + 1) * blk_sz, 0]
-        ty = np.clip(r * blk_sz + int(mvs[r, c, 0]), 0, self.height - blk_sz)
-        tx = np.clip(c * blk_sz + int(mvs[r, c, 1]), 0, self.width - blk_sz)
-        target = self.ref_yuv[ty:ty + blk_sz, tx:tx + blk_sz, 0]
-        for y, x in {(ty - blk_sz, tx), (ty + blk_sz, tx)}:
-          if 0 <= y < self.height - blk_sz and 0 <= x < self.width - blk_sz:
-            nb = self.ref_yuv[y:y + blk_sz, x:x + blk_sz, 0]
-            I_row += np.sum(np.abs(nb - center)) - np.sum(
-                np.abs(target - center))
-            count += 1
-        I_row //= (count * blk_sz * blk_sz)
-        count = 0
-        for y, x in {(ty, tx - blk_sz), (ty, tx + blk_sz)}:
-          if 0 <= y < self.height - blk_sz and 0 <= x < self.width - blk_sz:
-            nb = self.ref_yuv[y:y + blk_sz, x:x + blk_sz, 0]
-            I_col += np.sum(np.abs(nb - center)) - np.sum(
-                np.abs(target - center))
-            count += 1
-        I_col //= (count * blk_sz * blk_sz)
-        localDiff[r].append(
-            np.array([[I_row * I_row, I_row * I_col],
-                      [I_col * I_row, I_col * I_col]]))
-    return localDiff
+    return self.cached(
+        'local diff',
+        [self.cur_yuv[:, :, 0], self.ref_yuv[:, :, 0],
+         np.asarray(mvs, dtype=float)], self.blk_sz,
+        lambda: self.refLocalDiff(mvs))
 
   """
-    add smooth constraint
+    compute the local differentials of getRefLocalDiff, without the cache
     """
 
-  def smooth(self, uvs, mvs):
-    sm_uvs = np.zeros(uvs.shape)
+  def refLocalDiff(self, mvs):
     blk_sz = self.blk_sz
-    for r in xrange(self.num_row):
-      for c in xrange(self.num_col):
-        nb_uv = np.array([0.0, 0.0])
-        for i, j in {(r - 1, c), (r + 1, c), (r, c - 1), (r, c + 1)}:
-          if 0 <= i < self.num_row and 0 <= j < self.num_col:
-            nb_uv += uvs[i, j] / 6.0
-          else:
-            nb_uv += uvs[r, c] / 6.0
-        for i, j in {(r - 1, c - 1), (r - 1, c + 1), (r + 1, c - 1),
-                     (r + 1, c + 1)}:
-          if 0 <= i < self.num_row and 0 <= j < self.num_col:
-            nb_uv += uvs[i, j] / 12.0
-          else:
-            nb_uv += uvs[r, c] / 12.0
-        ssd_nb = self.block_dist(r, c, self.blk_sz * nb_uv)
-        mv = mvs[r, c]
-        ssd_mv = self.block_dist(r, c, mv)
-        alpha = (ssd_nb - ssd_mv) / (ssd_mv + 1e-6)
-        M = alpha * self.localDiff[r][c]
-        P = M + np.identity(2)
-        inv_P = LA.inv(P)
-        sm_uvs[r, c] = np.dot(inv_P, nb_uv) + np.dot(
-            np.matmul(inv_P, M), mv / blk_sz)
-    return sm_uvs
+    max_y = self.height - blk_sz
+    max_x = self.width - blk_sz
+    center = self.block_view(self.cur_yuv)[:, :, :, :, 0].astype(int)
+    offset = np.arange(blk_sz)
+
+    def sad(y, x):
+      nb = self.ref_yuv[y[:, :, None, None] + offset[:, None],
+                        x[:, :, None, None] + offset[None, :], 0]
+      return np.sum(np.abs(nb - center), axis=(2, 3))
+
+    ty = np.arange(self.num_row)[:, None] * blk_sz + mvs[:, :, 0].astype(int)
+    tx = np.arange(self.num_col)[None, :] * blk_sz + mvs[:, :, 1].astype(int)
+    ty = np.clip(ty, 0, max_y)
+    tx = np.clip(tx, 0, max_x)
+    target = sad(ty, tx)
+
+    #average sad difference of the neighbors inside the frame
+    def diff(nbs):
+      I = np.zeros((self.num_row, self.num_col), dtype=int)
+      count = np.zeros((self.num_row, self.num_col), dtype=int)
+      for y, x in nbs:
+        valid = (0 <= y) & (y < max_y) & (0 <= x) & (x < max_x)
+        nb = sad(np.clip(y, 0, max_y), np.clip(x, 0, max_x))
+        I += np.where(valid, nb - target, 0)
+        count += valid
+      return I // np.maximum(count * blk_sz * blk_sz, 1)
+
+    I_row = diff([(ty - blk_sz, tx), (ty + blk_sz, tx)])
+    I_col = diff([(ty, tx - blk_sz), (ty, tx + blk_sz)])
+    I = np.stack([I_row, I_col], axis=2)
+    return I[:, :, :, None] * I[:, :, None, :]
 
   def block_matching(self):
     self.search.motion_field_estimation()
 
+
+"""Search & Smooth Model with Adapt Weights"""
+
+
+class SearchSmoothAdapt(SearchSmooth):
+  """
+    Constructor:
+        cur_f: current frame
+        ref_f: reference frame
+        blk_sz: block size
+        wnd_size: search window size
+        beta: neigbor loss weight
+        max_iter: maximum number of iterations
+        metric: metric to compare the blocks distrotion
+    """
+
+  def __init__(self, cur_f, ref_f, blk_size, search, max_iter=100):
+    self.max_iter = max_iter
+    super(SearchSmoothAdapt, self).__init__(cur_f, ref_f, blk_size, search)
+
+  """
+    add smooth constraint
+    """
+
+  def smooth(self, uvs, mvs):
+    nb_uv = neighborAvg(uvs, NB8, border='self')
+    ssd_nb = self.field_dist(self.blk_sz * nb_uv)
+    ssd_mv = self.field_dist(mvs)
+    alpha = (ssd_nb - ssd_mv) / (ssd_mv + 1e-6)
+    M = alpha[:, :, None, None] * self.localDiff
+    P = M + np.identity(2)
+    #solve P.sm_uv = nb_uv + M.mv for all blocks at once
+    rhs = nb_uv + np.einsum('...ij,...j->...i', M, mvs / self.blk_sz)
+    return LA.solve(P, rhs[:, :, :, None])[:, :, :, 0]
+
   def motion_field_estimation(self):
     self.localDiff = self.getRefLocalDiff(self.search.mf)
     #get matching results
@@ -120,7 +136,7 @@ class SearchSmoothAdapt(MotionEST):
 """Search & Smooth Model with Fixed Weights"""
 
 
-class SearchSmoothFix(MotionEST):
+class SearchSmoothFix(SearchSmooth):
   """
     Constructor:
         cur_f: current frame
@@ -133,81 +149,22 @@ class SearchSmoothFix(MotionEST):
     """
 
   def __init__(self, cur_f, ref_f, blk_size, search, beta, max_iter=100):
-    self.search = search
     self.max_iter = max_iter
     self.beta = beta
-    super(SearchSmoothFix, self).__init__(cur_f, ref_f, blk_size)
-
-  """
-    get local diffiencial of refernce
-    """
-
-  def getRefLocalDiff(self, mvs):
-    m, n = self.num_row, self.num_col
-    localDiff = [[] for _ in xrange(m)]
-    blk_sz = self.blk_sz
-    for r in xrange(m):
-      for c in xrange(n):
-        I_row = 0
-        I_col = 0
-        #get ssd surface
-        count = 0
-        center = self.cur_yuv[r * blk_sz:(r + 1) * blk_sz,
-                              c * blk_sz:(c + 1) * blk_sz, 0]
-        ty = np.clip(r * blk_sz + int(mvs[r, c, 0]), 0, self.height - blk_sz)
-        tx = np.clip(c * blk_sz + int(mvs[r, c, 1]), 0, self.width - blk_sz)
-        target = self.ref_yuv[ty:ty + blk_sz, tx:tx + blk_sz, 0]
-        for y, x in {(ty - blk_sz, tx), (ty + blk_sz, tx)}:
-          if 0 <= y < self.height - blk_sz and 0 <= x < self.width - blk_sz:
-            nb = self.ref_yuv[y:y + blk_sz, x:x + blk_sz, 0]
-            I_row += np.sum(np.abs(nb - center)) - np.sum(
-                np.abs(target - center))
-            count += 1
-        I_row //= (count * blk_sz * blk_sz)
-        count = 0
-        for y, x in {(ty, tx - blk_sz), (ty, tx + blk_sz)}:
-          if 0 <= y < self.height - blk_sz and 0 <= x < self.width - blk_sz:
-            nb = self.ref_yuv[y:y + blk_sz, x:x + blk_sz, 0]
-            I_col += np.sum(np.abs(nb - center)) - np.sum(
-                np.abs(target - center))
-            count += 1
-        I_col //= (count * blk_sz * blk_sz)
-        localDiff[r].append(
-            np.array([[I_row * I_row, I_row * I_col],
-                      [I_col * I_row, I_col * I_col]]))
-    return localDiff
+    super(SearchSmoothFix, self).__init__(cur_f, ref_f, blk_size, search)
 
   """
     add smooth constraint
     """
 
   def smooth(self, uvs, mvs):
-    sm_uvs = np.zeros(uvs.shape)
-    blk_sz = self.blk_sz
-    for r in xrange(self.num_row):
-      for c in xrange(self.num_col):
-        nb_uv = np.array([0.0, 0.0])
-        for i, j in {(r - 1, c), (r + 1, c), (r, c - 1), (r, c + 1)}:
-          if 0 <= i < self.num_row and 0 <= j < self.num_col:
-            nb_uv += uvs[i, j] / 6.0
-          else:
-            nb_uv += uvs[r, c] / 6.0
-        for i, j in {(r - 1, c - 1), (r - 1, c + 1), (r + 1, c - 1),
-                     (r + 1, c + 1)}:
-          if 0 <= i < self.num_row and 0 <= j < self.num_col:
-            nb_uv += uvs[i, j] / 12.0
-          else:
-            nb_uv += uvs[r, c] / 12.0
-        mv = mvs[r, c] / blk_sz
-        M = self.localDiff[r][c]
-        P = M + self.beta * np.identity(2)
-        inv_P = LA.inv(P)
-        sm_uvs[r, c] = np.dot(inv_P, self.beta * nb_uv) + np.dot(
-            np.matmul(inv_P, M), mv)
-    return sm_uvs
-
-  def block_matching(self):
-    self.search.motion_field_estimation()
+    nb_uv = neighborAvg(uvs, NB8, border='self')
+    M = self.localDiff
+    P = M + self.beta * np.identity(2)
+    #solve P.sm_uv = beta.nb_uv + M.mv for all blocks at once
+    rhs = self.beta * nb_uv + np.einsum('...ij,...j->...i', M,
+                                        mvs / self.blk_sz)
+    return LA.solve(P, rhs[:, :, :, None])[:, :, :, 0]
 
   def motion_field_estimation(self):
     #get local structure
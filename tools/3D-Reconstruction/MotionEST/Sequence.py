@@ -0,0 +1,42 @@
+##  Copyright (c) 2020 The WebM project authors. All Rights Reserved.
+##
+##  Use of this source code is governed by a BSD-style license
+##  that can be found in the LICENSE file in the root of the source
+##  tree. An additional intellectual property rights grant can be found
+##  in the file PATENTS.  All contributing project authors may
+##  be found in the AUTHORS file in the root of the source tree.
+##
+
+# coding: utf-8
+from collections import deque
+from Util import toYUV
+from Y4M import Y4MReader
+"""Sequence Driver:
+
+  estimate the motion field of every frame of a sequence against the
+  previous frame
+"""
+"""
+  estimate a y4m sequence frame by frame:
+    path: y4m file path
+    make_est: builds an estimator from (cur_f, ref_f), for example
+              lambda cur_f, ref_f: Exhaust(cur_f, ref_f, 16, 16)
+    chroma: estimate on Y, U and V instead of the luma plane only
+  yields the index of the current frame and its estimator once its
+  motion field is estimated. only the current and the reference frames are
+  held in memory, and each frame is converted once: the current frame is
+  reused as the reference of the next one
+"""
+
+
+def estimateSequence(path, make_est, chroma=False):
+  reader = Y4MReader(path)
+  #converted frames of the current pair, the reference first
+  frames = deque(maxlen=2)
+  for k, planes in enumerate(reader):
+    frames.append(toYUV(tuple(planes) if chroma else planes[0]))
+    if len(frames) < 2:
+      continue
+    est = make_est(frames[1], frames[0])
+    est.motion_field_estimation()
+    yield k, est
@@ -0,0 +1,189 @@
+##  Copyright (c) 2020 The WebM project authors. All Rights Reserved.
+##
+##  Use of this source code is governed by a BSD-style license
+##  that can be found in the LICENSE file in the root of the source
+##  tree. An additional intellectual property rights grant can be found
+##  in the file PATENTS.  All contributing project authors may
+##  be found in the AUTHORS file in the root of the source tree.
+##
+
+# coding: utf-8
+import numpy as np
+from Util import MSE
+from MotionEST import MotionEST
+"""Sub-Pixel Refinement:
+
+  refine the motion field of any estimator to half or quarter pel against
+  interpolated reference planes
+"""
+
+#1/16 pel interpolation kernels of vp9/common/vp9_filter.c, applied to the
+#samples x - 3 to x + 4 and normalized by 1 << 7
+FILTERS = {
+    'bilinear':
+        np.array([[0, 0, 0, 128 - 8 * k, 8 * k, 0, 0, 0] for k in xrange(16)]),
+    '8tap':
+        np.array([[0, 0, 0, 128, 0, 0, 0, 0],
+                  [0, 1, -5, 126, 8, -3, 1, 0],
+                  [-1, 3, -10, 122, 18, -6, 2, 0],
+                  [-1, 4, -13, 118, 27, -9, 3, -1],
+                  [-1, 4, -16, 112, 37, -11, 4, -1],
+                  [-1, 5, -18, 105, 48, -14, 4, -1],
+                  [-1, 5, -19, 97, 58, -16, 5, -1],
+                  [-1, 6, -19, 88, 68, -18, 5, -1],
+                  [-1, 6, -19, 78, 78, -19, 6, -1],
+                  [-1, 5, -18, 68, 88, -19, 6, -1],
+                  [-1, 5, -16, 58, 97, -19, 5, -1],
+                  [-1, 4, -14, 48, 105, -18, 5, -1],
+                  [-1, 4, -11, 37, 112, -16, 4, -1],
+                  [-1, 3, -9, 27, 118, -13, 4, -1],
+                  [0, 2, -6, 18, 122, -10, 3, -1],
+                  [0, 1, -3, 8, 126, -5, 1, 0]])
+}
+"""
+  filter a padded frame along an axis, as one pass of vpx_convolve8:
+    pad: frame padded by 3 samples before and 4 after along axis
+    kernel: 8 taps
+    axis: 0 for rows, 1 for columns
+"""
+
+
+def convolve8(pad, kernel, axis):
+  n = pad.shape[axis] - 7
+  acc = np.zeros(pad.shape[:axis] + (n,) + pad.shape[axis + 1:], dtype=int)
+  for k in xrange(8):
+    if kernel[k]:
+      acc += kernel[k] * pad.take(np.arange(k, k + n), axis=axis)
+  return np.clip((acc + 64) >> 7, 0, 255)
+
+
+"""
+  interpolate a frame at every sub-pel phase:
+    yuv: frame of shape (height, width, channels)
+    precision: phases per pel, 2 for half and 4 for quarter pel
+    interp: 'bilinear' or '8tap'
+  returns an uint8 array of shape (precision, precision, height, width,
+  channels) whose [fy, fx, y, x] sample is the frame at
+  (y + fy / precision, x + fx / precision). the frame borders are extended
+  by replication, as libvpx extends its reference frames
+"""
+
+
+def interpolate(yuv, precision=4, interp='8tap'):
+  if 16 % precision:
+    raise ValueError('precision must divide 16, got %d' % precision)
+  kernels = FILTERS[interp][::16 // precision]
+  yuv = np.asarray(yuv, dtype=int)
+  pad = np.pad(yuv, ((3, 4), (3, 4), (0, 0)), mode='edge')
+  planes = np.empty((precision, precision) + yuv.shape, dtype=np.uint8)
+  for fx in xrange(precision):
+    #the horizontal pass first, on the rows of the vertical padding
+    rows = convolve8(pad, kernels[fx], 1)
+    for fy in xrange(precision):
+      planes[fy, fx] = convolve8(rows, kernels[fy], 0)
+  return planes
+
+
+"""Sub-Pixel Refinement of an Estimator"""
+
+
+class SubPelRefine(MotionEST):
+  """
+    Constructor:
+        cur_f: current frame
+        ref_f: reference frame
+        blk_sz: block size
+        search: estimator whose motion field is refined, already estimated
+        precision: phases per pel, 2 for half and 4 for quarter pel
+        interp: 'bilinear' or '8tap' interpolation of the reference
+        metric: metric to compare the blocks distrotion
+    starting from the search result rounded to the sub-pel grid, checks the
+    8 neighbors at a half pel step, then at a quarter pel step and so on
+    down to the precision, keeping the best of each round
+    """
+
+  def __init__(self,
+               cur_f,
+               ref_f,
+               blk_size,
+               search,
+               precision=4,
+               interp='8tap',
+               metric=MSE):
+    self.search = search
+    self.precision = precision
+    self.interp = interp
+    self.metric = metric
+    super(SubPelRefine, self).__init__(cur_f, ref_f, blk_size)
+    self.name = getattr(search, 'name',
+                        type(search).__name__) + ' + 1/%d pel' % precision
+    #interpolated reference, computed or fetched from the cache on first use
+    self.ref_planes = None
+
+  """
+    distortion of every block at a sub-pel motion vector:
+      mvs: motion field in units of 1 / precision pel
+      metric: distortion metric, the one of the estimator by default
+    returns a (num_row, num_col) map, inf where the integer part of the
+    motion vector falls outside the frame. a block may reach the last row
+    and column, the planes extend the frame beyond them
+    """
+
+  def subpel_dist(self, mvs, metric=None):
+    if self.ref_planes is None:
+      self.ref_planes = self.cached(
+          'sub-pel planes', [self.ref_yuv], (self.precision, self.interp),
+          lambda: interpolate(self.ref_yuv, self.precision, self.interp))
+    p = self.precision
+    blk_sz = self.blk_sz
+    ref_y = np.arange(self.num_row)[:, None] * blk_sz + mvs[:, :, 0] // p
+    ref_x = np.arange(self.num_col)[None, :] * blk_sz + mvs[:, :, 1] // p
+    valid = (0 <= ref_x) & (ref_x <= self.width - blk_sz) & (0 <= ref_y) & (
+        ref_y <= self.height - blk_sz)
+    offset = np.arange(blk_sz)
+    ref_blks = self.ref_planes[(mvs[:, :, 0] % p)[:, :, None, None],
+                               (mvs[:, :, 1] % p)[:, :, None, None],
+                               np.where(valid, ref_y, 0)[:, :, None, None] +
+                               offset[:, None],
+                               np.where(valid, ref_x, 0)[:, :, None, None] +
+                               offset[None, :]]
+    metric = self.metric if metric is None else metric
+    loss = metric(self.block_view(self.cur_yuv), ref_blks)
+    return np.where(valid, loss, np.inf)
+
+  """
+    distortion of every block under the sub-pel motion field, the blocks
+    matched outside the frame scored as by field_dist
+    """
+
+  def distortion_map(self, metric=MSE):
+    loss = self.subpel_dist(
+        np.round(self.mf * self.precision).astype(int), metric)
+    outside = np.isinf(loss)
+    if np.any(outside):
+      loss[outside] = self.field_dist(self.mf, metric)[outside]
+    return loss
+
+  def motion_field_estimation(self):
+    p = self.precision
+    mvs = np.round(self.search.mf * p).astype(int)
+    min_loss = self.subpel_dist(mvs)
+    self.evaluations = int(np.sum(np.isfinite(min_loss)))
+    #a start outside the frame keeps the loss the search gave it, so that
+    #only a candidate that beats it moves the block
+    outside = np.isinf(min_loss)
+    if np.any(outside):
+      min_loss[outside] = self.field_dist(mvs / float(p), self.metric)[outside]
+    step = p // 2
+    while step:
+      center = mvs.copy()
+      for dy, dx in ((-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1),
+                     (1, 0), (1, 1)):
+        cand = center + np.array([dy, dx]) * step
+        loss = self.subpel_dist(cand)
+        self.evaluations += int(np.sum(np.isfinite(loss)))
+        better = loss < min_loss
+        mvs[better] = cand[better]
+        min_loss[better] = loss[better]
+      step //= 2
+    self.mf = mvs / float(p)
@@ -15,10 +15,148 @@ from scipy.ndimage import filters
 from PIL import Image, ImageDraw
 
 
+"""
+  convert a frame to the YCbCr array of shape (height, width, channels) the
+  estimators use:
+    f: PIL image, converted to an int array with 3 channels
+       array of shape (height, width, 3), used as is
+       luma plane of shape (height, width), such as a uint8 array or a
+       memoryview, used without copying as a luma-only frame of 1 channel
+       tuple of (Y, U, V) planes, chroma upsampled to the size of the luma
+"""
+
+
+def toYUV(f):
+  if hasattr(f, 'convert'):
+    return np.array(f.convert('YCbCr'), dtype=int)
+  if isinstance(f, (tuple, list)):
+    planes = [np.asarray(p) for p in f]
+    if len(planes) == 1:
+      return planes[0][:, :, None]
+    height, width = planes[0].shape
+    yuv = np.empty((height, width, 3), dtype=planes[0].dtype)
+    yuv[:, :, 0] = planes[0]
+    for k in (1, 2):
+      h, w = planes[k].shape
+      #the standard subsampling factor that gives the chroma plane size
+      r = min(s for s in (1, 2, 4) if -(-height // s) == h)
+      c = min(s for s in (1, 2, 4) if -(-width // s) == w)
+      yuv[:, :, k] = planes[k].repeat(r, axis=0).repeat(
+          c, axis=1)[:height, :width]
+    return yuv
+  f = np.asarray(f)
+  if f.ndim == 2:
+    return f[:, :, None]
+  return f
+
+
+"""
+  metrics reduce the trailing (h, w, channels) axes of the blocks, so a stack
+  of blocks shaped (..., h, w, channels) is scored in one call
+"""
+
+
 def MSE(blk1, blk2):
+  diff = np.asarray(blk1, dtype=int) - np.asarray(blk2, dtype=int)
+  #per pixel L2 norm across channels
   return np.mean(
-      LA.norm(
-          np.array(blk1, dtype=int) - np.array(blk2, dtype=int), axis=2))
+      np.sqrt(np.einsum('...k,...k->...', diff, diff)), axis=(-2, -1))
+
+
+"""
+  statistics of an error map:
+    err: error of every block
+    mask: blocks to leave out, None for none
+    percentiles: percentiles to report
+  returns a dict of the mean, the max and every percentile, keyed 'p50' etc
+"""
+
+
+def errorStats(err, mask=None, percentiles=(50, 90, 95, 99)):
+  err = np.asarray(err)
+  if mask is not None:
+    err = err[~np.asarray(mask, dtype=bool)]
+  stats = {'mean': np.mean(err), 'max': np.max(err)}
+  for p, v in zip(percentiles, np.percentile(err, percentiles)):
+    stats['p%g' % p] = v
+  return stats
+
+
+"""
+  format reports of MotionEST.profile as a table:
+    reports: list of reports, the first one is the baseline of the speedup
+  the columns missing from a report are left blank
+"""
+
+
+def profileTable(reports):
+  columns = [('time', '%.3fs'), ('speedup', '%.1fx'), ('evals', '%.1f'),
+             ('epe_mean', '%.3f'), ('epe_p90', '%.3f'), ('epe_max', '%.3f')]
+  width = max(len(r['name']) for r in reports)
+  lines = [' '.join(['%-*s' % (width, 'name')] +
+                    ['%10s' % name for name, _ in columns])]
+  for r in reports:
+    r = dict(r, speedup=reports[0]['time'] / max(r['time'], 1e-9))
+    cells = [fmt % r[name] if name in r else '' for name, fmt in columns]
+    lines.append(' '.join(['%-*s' % (width, r['name'])] +
+                          ['%10s' % c for c in cells]))
+  return '\n'.join(lines)
+
+
+"""
+  summed-area table of a 2D array, padded with a leading row and column of
+  zeros so that S[y1, x1] - S[y0, x1] - S[y1, x0] + S[y0, x0] is the sum of
+  I[y0:y1, x0:x1]
+"""
+
+
+def integralImage(I):
+  S = np.zeros((I.shape[0] + 1, I.shape[1] + 1), dtype=np.result_type(I, int))
+  np.cumsum(I, axis=0, out=S[1:, 1:])
+  np.cumsum(S[1:, 1:], axis=1, out=S[1:, 1:])
+  return S
+
+
+"""
+  sum of each block of size h x w from a summed-area table:
+    S: summed-area table from integralImage
+    ys: top rows of the blocks
+    xs: left columns of the blocks
+  ys and xs broadcast against each other
+"""
+
+
+def rectSum(S, ys, xs, h, w):
+  return S[ys + h, xs + w] - S[ys, xs + w] - S[ys + h, xs] + S[ys, xs]
+
+
+"""
+  neighbor weights of the smoothness constraints:
+    NB8: 1/6 for the 4-connected and 1/12 for the diagonal neighbors
+    NB4: 1/4 for the 4-connected neighbors
+"""
+NB8 = np.array([[1 / 12.0, 1 / 6.0, 1 / 12.0], [1 / 6.0, 0, 1 / 6.0],
+                [1 / 12.0, 1 / 6.0, 1 / 12.0]])
+NB4 = np.array([[0, 0.25, 0], [0.25, 0, 0.25], [0, 0.25, 0]])
+"""
+  weighted average of the neighbors of every motion vector:
+    mf: motion field of shape (num_row, num_col, 2)
+    weights: 3x3 neighbor weights
+    border: 'zero' when neighbors outside the field contribute nothing,
+            'self' when they are replaced by the motion vector itself
+"""
+
+
+def neighborAvg(mf, weights, border='zero'):
+  avg = np.empty(mf.shape)
+  for k in xrange(mf.shape[2]):
+    filters.correlate(mf[:, :, k], weights, output=avg[:, :, k],
+                      mode='constant')
+  if border == 'self':
+    inside = filters.correlate(
+        np.ones(mf.shape[:2]), weights, mode='constant')
+    avg += (np.sum(weights) - inside)[:, :, None] * mf
+  return avg
 
 
 def drawMF(img, blk_sz, mf):
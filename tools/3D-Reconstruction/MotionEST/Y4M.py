@@ -0,0 +1,148 @@
+##  Copyright (c) 2020 The WebM project authors. All Rights Reserved.
+##
+##  Use of this source code is governed by a BSD-style license
+##  that can be found in the LICENSE file in the root of the source
+##  tree. An additional intellectual property rights grant can be found
+##  in the file PATENTS.  All contributing project authors may
+##  be found in the AUTHORS file in the root of the source tree.
+##
+
+# coding: utf-8
+import os
+import numpy as np
+"""Y4M Reader:
+
+  read the YUV4MPEG2 sequences written by genY4M
+"""
+
+#chroma (row, column) subsampling of each color space
+SUBSAMPLES = {'420': (2, 2), '422': (1, 2), '444': (1, 1), '411': (1, 4)}
+"""
+  parse the stream header:
+    line: header line
+  returns width, height and the (row, column) subsampling of the chroma
+  planes, None for monochrome sequences
+"""
+
+
+def parseHeader(line):
+  tokens = line.split()
+  if not tokens or tokens[0] != 'YUV4MPEG2':
+    raise ValueError('not a YUV4MPEG2 stream')
+  params = dict((t[0], t[1:]) for t in tokens[1:])
+  width = int(params['W'])
+  height = int(params['H'])
+  cs = params.get('C', '420')
+  if cs.startswith('mono'):
+    return width, height, None
+  #420jpeg, 420paldv and 420mpeg2 only differ in chroma siting
+  if cs[:3] not in SUBSAMPLES or cs[3:] not in ('', 'jpeg', 'paldv',
+                                                'mpeg2'):
+    raise ValueError('unsupported color space: C' + cs)
+  return width, height, SUBSAMPLES[cs[:3]]
+
+
+"""
+  shapes of the planes of a frame:
+    width, height: frame size
+    sub: chroma subsampling from parseHeader
+"""
+
+
+def planeShapes(width, height, sub):
+  if sub is None:
+    return [(height, width)]
+  c_shape = (-(-height // sub[0]), -(-width // sub[1]))
+  return [(height, width), c_shape, c_shape]
+
+
+"""Streaming Reader"""
+
+
+class Y4MReader(object):
+  """
+    constructor:
+        path: y4m file path
+    iterating over the reader yields the planes of each frame in order as
+    uint8 arrays, reading one frame at a time
+    """
+
+  def __init__(self, path):
+    self.path = path
+    with open(path, 'rb') as y4m:
+      header = y4m.readline()
+    self.header_size = len(header)
+    self.width, self.height, self.sub = parseHeader(header.decode('ascii'))
+    self.shapes = planeShapes(self.width, self.height, self.sub)
+    self.frame_size = sum(h * w for h, w in self.shapes)
+
+  def __iter__(self):
+    with open(self.path, 'rb') as y4m:
+      y4m.seek(self.header_size)
+      while True:
+        line = y4m.readline()
+        if not line:
+          return
+        if not line.startswith(b'FRAME'):
+          raise ValueError('missing FRAME marker in ' + self.path)
+        data = y4m.read(self.frame_size)
+        if len(data) < self.frame_size:
+          raise ValueError('truncated frame in ' + self.path)
+        yield self.split(np.frombuffer(data, dtype=np.uint8))
+
+  """
+    split the samples of a frame into its planes
+    """
+
+  def split(self, buf):
+    planes = []
+    offset = 0
+    for h, w in self.shapes:
+      planes.append(buf[offset:offset + h * w].reshape(h, w))
+      offset += h * w
+    return planes
+
+
+"""Memory-Mapped Reader"""
+
+
+class Y4MMap(Y4MReader):
+  """
+    constructor:
+        path: y4m file path
+    maps the file and indexes the offset of every frame once, so frame k is
+    read with reader[k] in constant time. the planes are uint8 memmap views
+    of the file, nothing is copied until they are used. the luma plane can
+    be passed to an estimator as a frame, for example
+        Exhaust(y4m[k][0], y4m[k - 1][0], 16, 16)
+    """
+
+  def __init__(self, path):
+    super(Y4MMap, self).__init__(path)
+    self.offsets = []
+    with open(path, 'rb') as y4m:
+      size = os.fstat(y4m.fileno()).st_size
+      offset = self.header_size
+      while offset < size:
+        y4m.seek(offset)
+        #FRAME markers may carry parameters, so their length varies
+        line = y4m.readline()
+        if not line.startswith(b'FRAME'):
+          raise ValueError('missing FRAME marker in ' + path)
+        offset += len(line)
+        if offset + self.frame_size > size:
+          raise ValueError('truncated frame in ' + path)
+        self.offsets.append(offset)
+        offset += self.frame_size
+    self.data = np.memmap(path, dtype=np.uint8, mode='r')
+
+  def __len__(self):
+    return len(self.offsets)
+
+  def __getitem__(self, k):
+    offset = self.offsets[k]
+    return self.split(self.data[offset:offset + self.frame_size])
+
+  def __iter__(self):
+    for k in range(len(self)):
+      yield self[k]
@@ -0,0 +1,102 @@
+##  Copyright (c) 2020 The WebM project authors. All Rights Reserved.
+##
+##  Use of this source code is governed by a BSD-style license
+##  that can be found in the LICENSE file in the root of the source
+##  tree. An additional intellectual property rights grant can be found
+##  in the file PATENTS.  All contributing project authors may
+##  be found in the AUTHORS file in the root of the source tree.
+##
+
+# coding: utf-8
+import argparse
+import time
+import numpy as np
+from PIL import Image
+from Exhaust import Exhaust
+from Metric import SAD, SSE, SATD
+from Util import MSE
+"""Exhaust Search Benchmark:
+
+  time of Exhaust.motion_field_estimation, the batched search, against the
+  per candidate loop it replaced, on synthetic frames of several
+  resolutions, and check that both give the same motion field. run from
+  this directory: python benchExhaust.py
+"""
+
+METRICS = {'MSE': MSE, 'SAD': SAD, 'SSE': SSE, 'SATD': SATD}
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--sizes", default="176x144,352x288", type=str)
+parser.add_argument("--blk_sz", default=16, type=int)
+parser.add_argument("--wnd_sz", default=16, type=int)
+parser.add_argument("--metric", default="MSE", choices=sorted(METRICS))
+#worker processes of the batched search, 1 runs it serially
+parser.add_argument("--workers", default=1, type=int)
+#the loop takes minutes from CIF up, skip it above this many blocks
+parser.add_argument("--loop_max_blocks", default=400, type=int)
+"""
+  synthetic frames: a noisy textured luma and a smooth chroma, the current
+  frame matching the reference at an offset of 3 rows and -5 columns
+"""
+
+
+def frames(width, height):
+  y, x = np.mgrid[0:height + 16, 0:width + 16]
+  noise = np.random.RandomState(0).randint(0, 24, x.shape)
+  luma = 128 + 50 * np.sin(x / 6.0) * np.cos(y / 9.0) + noise
+  u = 128 + 30 * np.sin(y / 13.0)
+  v = 128 + 30 * np.cos(x / 17.0)
+  yuv = np.stack([luma, u, v], axis=2).clip(0, 255).astype(np.uint8)
+  cur = Image.fromarray(
+      np.ascontiguousarray(yuv[4:height + 4, 4:width + 4]), 'YCbCr')
+  ref = Image.fromarray(
+      np.ascontiguousarray(yuv[1:height + 1, 9:width + 9]), 'YCbCr')
+  return cur, ref
+
+
+"""
+  the search the batched engine replaced: block_dist once per candidate of
+  every block, the first minimum in raster order winning
+"""
+
+
+def loopEstimation(est):
+  blk_sz, wnd = est.blk_sz, est.wnd_sz
+  for i in xrange(est.num_row):
+    for j in xrange(est.num_col):
+      min_loss = est.block_dist(i, j, [0, 0], est.metric)
+      best = [0, 0]
+      for dy in xrange(-wnd, wnd):
+        for dx in xrange(-wnd, wnd):
+          y, x = i * blk_sz + dy, j * blk_sz + dx
+          if 0 <= x < est.width - blk_sz and 0 <= y < est.height - blk_sz:
+            loss = est.block_dist(i, j, [dy, dx], est.metric)
+            if loss < min_loss:
+              min_loss = loss
+              best = [dy, dx]
+      est.mf[i, j] = best
+
+
+if __name__ == "__main__":
+  args = parser.parse_args()
+  metric = METRICS[args.metric]
+  print("%-10s %10s %12s %9s %6s" % ("size", "loop (s)", "batched (s)",
+                                     "speedup", "same"))
+  for s in args.sizes.split(","):
+    size = tuple(int(v) for v in s.split("x"))
+    cur_f, ref_f = frames(*size)
+    est = Exhaust(cur_f, ref_f, args.blk_sz, args.wnd_sz, metric)
+    est.workers = args.workers
+    start = time.time()
+    est.motion_field_estimation()
+    batched = time.time() - start
+    if est.num_row * est.num_col > args.loop_max_blocks:
+      print("%-10s %10s %12.3f" % (s, "skipped", batched))
+      continue
+    loop = Exhaust(cur_f, ref_f, args.blk_sz, args.wnd_sz, metric)
+    start = time.time()
+    loopEstimation(loop)
+    elapsed = time.time() - start
+    print("%-10s %10.3f %12.3f %8.1fx %6s" %
+          (s, elapsed, batched, elapsed / batched,
+           np.array_equal(est.mf, loop.mf)))
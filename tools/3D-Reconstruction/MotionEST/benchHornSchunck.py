@@ -0,0 +1,149 @@
+##  Copyright (c) 2020 The WebM project authors. All Rights Reserved.
+##
+##  Use of this source code is governed by a BSD-style license
+##  that can be found in the LICENSE file in the root of the source
+##  tree. An additional intellectual property rights grant can be found
+##  in the file PATENTS.  All contributing project authors may
+##  be found in the AUTHORS file in the root of the source tree.
+##
+
+# coding: utf-8
+import argparse
+import multiprocessing
+import resource
+import sys
+import time
+import numpy as np
+from PIL import Image
+from scipy.sparse import csc_matrix
+from scipy.sparse.linalg import inv
+from HornSchunck import HornSchunck
+"""HornSchunck Solver Benchmark:
+
+  time and peak memory of HornSchunck.motion_field_estimation_mat with the
+  direct and the conjugate gradient solvers, against the list assembly and
+  sparse inverse it replaced, on synthetic frames of several resolutions.
+  every run is a fresh process so that the memory of one does not hide the
+  next. run from this directory: python benchHornSchunck.py
+"""
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--sizes", default="176x144,352x288,704x576", type=str)
+parser.add_argument("--blk_sz", default=4, type=int)
+parser.add_argument("--alpha", default=1.0, type=float)
+parser.add_argument("--sigma", default=1.0, type=float)
+parser.add_argument("--solvers", default="inv,direct,cg", type=str)
+#the sparse inverse fills in, a few thousand blocks already take gigabytes
+parser.add_argument("--inv_max_blocks", default=2000, type=int)
+"""
+  synthetic frames: smooth texture, the reference shifted by 1 row and 2
+  columns
+"""
+
+
+def frames(width, height):
+  y, x = np.mgrid[0:height, 0:width]
+  luma = 128 + 60 * np.sin(x / 7.0) * np.cos(y / 5.0) + 40 * np.sin(
+      (x + y) / 11.0)
+  cur = np.repeat(luma[:, :, None], 3, axis=2).astype(np.uint8)
+  ref = np.roll(np.roll(cur, 1, axis=0), 2, axis=1)
+  return Image.fromarray(cur, 'RGB'), Image.fromarray(ref, 'RGB')
+
+
+"""
+  the solve the vectorized assembly replaced: entries appended one at a
+  time, then the sparse inverse applied to the right hand side
+"""
+
+
+def legacySolve(hs):
+  m, n = hs.num_row, hs.num_col
+  a2 = hs.alpha**2
+  row_idx = []
+  col_idx = []
+  data = []
+  N = 2 * m * n
+  b = np.zeros((N, 1))
+  for i in xrange(m):
+    for j in xrange(n):
+      u_idx = i * 2 * n + 2 * j
+      v_idx = u_idx + 1
+      b[u_idx, 0] = -hs.Ix[i, j] * hs.It[i, j]
+      b[v_idx, 0] = -hs.Iy[i, j] * hs.It[i, j]
+      for r, c, v in ((u_idx, u_idx, hs.Ix[i, j] * hs.Ix[i, j] + a2),
+                      (u_idx, v_idx, hs.Ix[i, j] * hs.Iy[i, j]),
+                      (v_idx, u_idx, hs.Ix[i, j] * hs.Iy[i, j]),
+                      (v_idx, v_idx, hs.Iy[i, j] * hs.Iy[i, j] + a2)):
+        row_idx.append(r)
+        col_idx.append(c)
+        data.append(v)
+      for r, c, w in ((-1, 0, 6.0), (1, 0, 6.0), (0, -1, 6.0), (0, 1, 6.0),
+                      (-1, -1, 12.0), (-1, 1, 12.0), (1, -1, 12.0),
+                      (1, 1, 12.0)):
+        if 0 <= i + r < m and 0 <= j + c < n:
+          u_nb = (i + r) * 2 * n + 2 * (j + c)
+          for k in (0, 1):
+            row_idx.append(u_idx + k)
+            col_idx.append(u_nb + k)
+            data.append(-a2 / w)
+  M = csc_matrix((data, (row_idx, col_idx)), shape=(N, N))
+  uv = inv(M).dot(b)
+  hs.mf[:, :, 0] = uv[1::2, 0].reshape(m, n) * hs.blk_sz
+  hs.mf[:, :, 1] = uv[0::2, 0].reshape(m, n) * hs.blk_sz
+
+
+"""
+  one solve in the current process:
+    args: parsed arguments
+    size: (width, height)
+    solver: 'inv', 'direct' or 'cg'
+  returns the seconds of the solve, the peak memory it added in MB and the
+  motion field
+"""
+
+
+def run(args, size, solver):
+  cur_f, ref_f = frames(*size)
+  hs = HornSchunck(cur_f, ref_f, args.blk_sz, args.alpha, args.sigma)
+  base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  start = time.time()
+  if solver == 'inv':
+    legacySolve(hs)
+  else:
+    hs.motion_field_estimation_mat(solver)
+  elapsed = time.time() - start
+  peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - base
+  #ru_maxrss is in bytes on macOS, in KB elsewhere
+  scale = 1 << 20 if sys.platform == 'darwin' else 1 << 10
+  return elapsed, peak / float(scale), hs.mf
+
+
+def runIsolated(job):
+  return run(*job)
+
+
+if __name__ == "__main__":
+  args = parser.parse_args()
+  sizes = [tuple(int(v) for v in s.split("x")) for s in args.sizes.split(",")]
+  solvers = args.solvers.split(",")
+  print("%-10s %-7s %10s %10s %14s" % ("size", "solver", "time (s)",
+                                       "peak (MB)", "max diff (px)"))
+  for size in sizes:
+    blocks = (size[0] // args.blk_sz) * (size[1] // args.blk_sz)
+    ref_mf = None
+    for solver in solvers:
+      if solver == 'inv' and blocks > args.inv_max_blocks:
+        print("%-10s %-7s %10s" % ("%dx%d" % size, solver, "skipped"))
+        continue
+      pool = multiprocessing.Pool(1)
+      try:
+        elapsed, peak, mf = pool.apply(runIsolated, ((args, size, solver),))
+      finally:
+        pool.close()
+        pool.join()
+      #differences against the first solver run at this size
+      if ref_mf is None:
+        ref_mf = mf
+      print("%-10s %-7s %10.3f %10.1f %14.2g" %
+            ("%dx%d" % size, solver, elapsed, peak,
+             np.max(np.abs(mf - ref_mf))))
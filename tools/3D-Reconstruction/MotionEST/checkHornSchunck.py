@@ -0,0 +1,106 @@
+##  Copyright (c) 2020 The WebM project authors. All Rights Reserved.
+##
+##  Use of this source code is governed by a BSD-style license
+##  that can be found in the LICENSE file in the root of the source
+##  tree. An additional intellectual property rights grant can be found
+##  in the file PATENTS.  All contributing project authors may
+##  be found in the AUTHORS file in the root of the source tree.
+##
+
+# coding: utf-8
+import sys
+import numpy as np
+from PIL import Image
+from HornSchunck import HornSchunck
+"""HornSchunck Regression Check:
+
+  the block intensities and the derivatives of HornSchunck on fixed
+  synthetic frames, pinned to the outputs of the per block loops they
+  replaced. run from this directory: python checkHornSchunck.py
+"""
+
+#outputs of the loops on frames(), blk_sz 4, alpha 1 and sigma 0.5
+CUR_I = np.array([
+    [20.5625, 45, 67.6875, 84.8125, 103.9375, 121.5],
+    [58.8125, 89.4375, 103.625, 122.1875, 139.8125, 153.9375],
+    [95.5625, 117.5625, 134.75, 153, 172.0625, 162.9375],
+    [126.9375, 150.0625, 167.0625, 188.5, 203.5625, 155.5],
+    [160, 181.8125, 200.3125, 217.625, 174.5, 91.25]
+])
+REF_I = np.array([
+    [82.8125, 70.5625, 80.25, 74.75, 79.4375, 90],
+    [91, 66.875, 89.75, 105.8125, 121.6875, 140.875],
+    [96.9375, 102.9375, 119.8125, 135.9375, 153.6875, 172.625],
+    [128.5625, 134.375, 150.5, 169.75, 185.375, 188.875],
+    [125.25, 166.6875, 184.25, 200.0625, 219.3125, 165.3125]
+])
+IX = np.array([
+    [5.9678687896, 15.3840979693, 12.4703561892,
+     14.1426103872, 13.1181830688, 0],
+    [8.80426467459, 16.5985120893, 16.9242893921,
+     16.2617809197, 9.0502322537, 0],
+    [13.2721329384, 16.8690478533, 18.0429647839,
+     12.9146943635, -6.64986822936, 0],
+    [19.9480657223, 18.0221633588, 16.4197979005,
+     -1.26075988288, -34.3866779342, 0],
+    [0, 0, 0, 0, 0, 0]
+])
+IY = np.array([
+    [20.082712981, 20.8293205268, 25.7673062649,
+     31.7096614469, 34.3195308015, 0],
+    [26.6696807883, 29.9738832475, 30.7042448323,
+     31.3349933858, 26.7763437487, 0],
+    [30.2887635726, 31.7229651414, 32.3818147124,
+     29.5226549944, 15.0341175922, 0],
+    [21.8870746373, 28.2819213579, 27.1530204089,
+     14.2135589972, -13.2101675518, 0],
+    [0, 0, 0, 0, 0, 0]
+])
+IT = np.array([
+    [23.5940302592, 2.26357049645, -7.27152532171,
+     -16.6054625136, -20.758715778, 0],
+    [1.31608349583, -12.9153865321, -15.0410112162,
+     -16.4223951258, -9.87639627244, 0],
+    [-7.17780966721, -14.8218716099, -16.5650941747,
+     -14.2375985281, 3.63459053001, 0],
+    [-16.0056572437, -15.9474024909, -15.4165374266,
+     -0.19330615597, 31.1864147156, 0],
+    [0, 0, 0, 0, 0, 0]
+])
+#the loops summed in another order
+TOLERANCE = 1e-9
+"""
+  fixed 26x22 RGB frames, the reference the current frame shifted by 1 row
+  and 2 columns. the size is not a multiple of the block size, so the
+  intensities leave the last rows and columns out
+"""
+
+
+def frames(height=22, width=26):
+  y, x = np.mgrid[0:height, 0:width]
+  cur = np.stack([(9 * x + 5 * y + x * y % 23) % 256, (3 * x + 11 * y) % 256,
+                  7 * x * y % 256],
+                 axis=2).astype(np.uint8)
+  ref = np.roll(np.roll(cur, 1, axis=0), 2, axis=1)
+  return Image.fromarray(cur, 'RGB'), Image.fromarray(ref, 'RGB')
+
+
+if __name__ == "__main__":
+  cur_f, ref_f = frames()
+  hs = HornSchunck(cur_f, ref_f, 4, 1.0, 0.5)
+  cur_I, ref_I = hs.getIntensity()
+  Ix, Iy, It = hs.intensityDiff()
+  failed = False
+  for name, out, pinned in (('getIntensity cur_I', cur_I, CUR_I),
+                            ('getIntensity ref_I', ref_I, REF_I),
+                            ('intensityDiff Ix', Ix, IX),
+                            ('intensityDiff Iy', Iy, IY),
+                            ('intensityDiff It', It, IT)):
+    if out.shape == pinned.shape:
+      err = np.max(np.abs(out - pinned))
+    else:
+      err = np.inf
+    ok = err <= TOLERANCE
+    failed = failed or not ok
+    print("%-20s %s  max error %.3g" % (name, "ok" if ok else "FAILED", err))
+  sys.exit(1 if failed else 0)
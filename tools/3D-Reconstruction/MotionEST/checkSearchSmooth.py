@@ -0,0 +1,117 @@
+##  Copyright (c) 2020 The WebM project authors. All Rights Reserved.
+##
+##  Use of this source code is governed by a BSD-style license
+##  that can be found in the LICENSE file in the root of the source
+##  tree. An additional intellectual property rights grant can be found
+##  in the file PATENTS.  All contributing project authors may
+##  be found in the AUTHORS file in the root of the source tree.
+##
+
+# coding: utf-8
+import sys
+import numpy as np
+import numpy.linalg as LA
+from PIL import Image
+from Exhaust import Exhaust
+from SearchSmooth import SearchSmoothAdapt, SearchSmoothFix
+"""SearchSmooth Regression Check:
+
+  the batched solve of SearchSmoothAdapt and SearchSmoothFix against the
+  per block inverse it replaced, on fixed textured and flat synthetic
+  frames. run from this directory: python checkSearchSmooth.py
+"""
+
+#largest difference in pels to the per block loops. where a block matches
+#its reference almost exactly, as on flat frames, the adaptive weight
+#reaches 1e6 and more, the 2x2 systems are ill conditioned and the inverse
+#and the solve round apart, by up to about 1e-3 pel
+TOLERANCES = {
+    ('adapt', 'textured'): 1e-9,
+    ('adapt', 'flat'): 5e-3,
+    ('fix', 'textured'): 1e-9,
+    ('fix', 'flat'): 1e-9,
+}
+"""
+  fixed 64x48 RGB frames, the reference the current frame shifted by 1 row
+  and 2 columns:
+    kind: 'textured' for a textured luma and a noisy reference, or 'flat'
+          for a nearly uniform luma and an exact reference
+"""
+
+
+def frames(kind, height=48, width=64):
+  y, x = np.mgrid[0:height, 0:width]
+  if kind == 'flat':
+    luma = 128 + (x // 16 + y // 16) % 2
+  else:
+    luma = (9 * x + 5 * y + x * y % 23) % 256
+  cur = np.stack([luma, (3 * x + 11 * y) % 256, 7 * x * y % 256],
+                 axis=2).astype(np.uint8)
+  ref = np.roll(np.roll(cur, 1, axis=0), 2, axis=1)
+  if kind != 'flat':
+    noise = np.random.RandomState(0).randint(-2, 3, ref.shape)
+    ref = np.clip(ref + noise, 0, 255).astype(np.uint8)
+  return Image.fromarray(cur, 'RGB'), Image.fromarray(ref, 'RGB')
+
+
+"""
+  one smoothing iteration as the per block loops computed it:
+    est: SearchSmoothAdapt or SearchSmoothFix with localDiff set
+    uvs: current estimation
+    mvs: matching results
+"""
+
+
+def legacySmooth(est, uvs, mvs):
+  sm_uvs = np.zeros(uvs.shape)
+  blk_sz = est.blk_sz
+  for r in xrange(est.num_row):
+    for c in xrange(est.num_col):
+      nb_uv = np.array([0.0, 0.0])
+      for i, j in {(r - 1, c), (r + 1, c), (r, c - 1), (r, c + 1)}:
+        if 0 <= i < est.num_row and 0 <= j < est.num_col:
+          nb_uv += uvs[i, j] / 6.0
+        else:
+          nb_uv += uvs[r, c] / 6.0
+      for i, j in {(r - 1, c - 1), (r - 1, c + 1), (r + 1, c - 1),
+                   (r + 1, c + 1)}:
+        if 0 <= i < est.num_row and 0 <= j < est.num_col:
+          nb_uv += uvs[i, j] / 12.0
+        else:
+          nb_uv += uvs[r, c] / 12.0
+      if isinstance(est, SearchSmoothAdapt):
+        ssd_nb = est.block_dist(r, c, blk_sz * nb_uv)
+        ssd_mv = est.block_dist(r, c, mvs[r, c])
+        alpha = (ssd_nb - ssd_mv) / (ssd_mv + 1e-6)
+        M = alpha * est.localDiff[r][c]
+        P = M + np.identity(2)
+      else:
+        M = est.localDiff[r][c]
+        P = M + est.beta * np.identity(2)
+        nb_uv = est.beta * nb_uv
+      inv_P = LA.inv(P)
+      sm_uvs[r, c] = np.dot(inv_P, nb_uv) + np.dot(
+          np.matmul(inv_P, M), mvs[r, c] / blk_sz)
+  return sm_uvs
+
+
+if __name__ == "__main__":
+  failed = False
+  for kind in ('textured', 'flat'):
+    cur_f, ref_f = frames(kind)
+    search = Exhaust(cur_f, ref_f, 8, 4)
+    search.motion_field_estimation()
+    for name, est in (('adapt', SearchSmoothAdapt(cur_f, ref_f, 8, search,
+                                                  20)),
+                      ('fix', SearchSmoothFix(cur_f, ref_f, 8, search, 0.5,
+                                              20))):
+      est.motion_field_estimation()
+      uvs = search.mf / est.blk_sz
+      for _ in xrange(est.max_iter):
+        uvs = legacySmooth(est, uvs, search.mf)
+      err = np.max(np.abs(est.mf - uvs * est.blk_sz))
+      ok = err <= TOLERANCES[name, kind]
+      failed = failed or not ok
+      print("%-6s %-9s %s  max error %.3g" % (name, kind, "ok"
+                                              if ok else "FAILED", err))
+  sys.exit(1 if failed else 0)
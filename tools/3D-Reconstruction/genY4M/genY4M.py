@@ -8,7 +8,11 @@
 ##
 
 import argparse
+from collections import deque
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 from os import listdir, path
+import numpy as np
 from PIL import Image
 import sys
 
@@ -19,36 +23,58 @@ parser.add_argument("--interlacing", default="Ip", type=str)
 parser.add_argument("--pix_ratio", default="0:0", type=str)
 parser.add_argument("--color_space", default="4:2:0", type=str)
 parser.add_argument("--output", default="output.y4m", type=str)
+parser.add_argument("--workers", default=cpu_count(), type=int)
 
 
+#frames are (index, frame) pairs in index order, a frame is a PIL image or a
+#YCbCr array, and they are consumed one at a time
 def generate(args, frames):
-  if len(frames) == 0:
-    return
-  #sort the frames based on the frame index
-  frames = sorted(frames, key=lambda x: x[0])
-  #convert the frames to YUV form
-  frames = [f.convert("YCbCr") for _, f in frames]
-  #write the header
-  header = "YUV4MPEG2 W%d H%d F%s %s A%s" % (frames[0].width, frames[0].height,
-                                             args.frame_rate, args.interlacing,
-                                             args.pix_ratio)
-  cs = args.color_space.split(":")
-  header += " C%s%s%s\n" % (cs[0], cs[1], cs[2])
   #estimate the sample step based on subsample value
+  cs = args.color_space.split(":")
   subsamples = [int(c) for c in cs]
   r_step = [1, int(subsamples[2] == 0) + 1, int(subsamples[2] == 0) + 1]
   c_step = [1, 4 // subsamples[1], 4 // subsamples[1]]
-  #write in frames
   with open(args.output, "wb") as y4m:
-    y4m.write(header)
-    for f in frames:
-      y4m.write("FRAME\n")
-      px = f.load()
-      for k in xrange(3):
-        for i in xrange(0, f.height, r_step[k]):
-          for j in xrange(0, f.width, c_step[k]):
-            yuv = px[j, i]
-            y4m.write(chr(yuv[k]))
+    for n, (_, f) in enumerate(frames):
+      #convert one frame at a time to YUV planes
+      if isinstance(f, np.ndarray):
+        yuv = f
+      else:
+        yuv = np.asarray(f.convert("YCbCr"))
+      if n == 0:
+        #write the header
+        header = "YUV4MPEG2 W%d H%d F%s %s A%s" % (
+            yuv.shape[1], yuv.shape[0], args.frame_rate, args.interlacing,
+            args.pix_ratio)
+        header += " C%s%s%s\n" % (cs[0], cs[1], cs[2])
+        y4m.write(header.encode("ascii"))
+      y4m.write(b"FRAME\n")
+      for k in range(3):
+        #keep the top left sample of every subsampled area
+        plane = yuv[::r_step[k], ::c_step[k], k]
+        y4m.write(np.ascontiguousarray(plane).tobytes())
+
+
+def loadFrame(filename):
+  return np.asarray(Image.open(filename).convert("YCbCr"))
+
+
+#decode the frames in a pool of threads, yielding them in order. at most
+#2 * workers frames are decoding or waiting to be written at any time
+def decodeFrames(frames, workers):
+  pool = ThreadPool(workers)
+  try:
+    pending = deque()
+    for idx, filename in frames:
+      pending.append((idx, pool.apply_async(loadFrame, (filename,))))
+      if len(pending) == 2 * workers:
+        idx, res = pending.popleft()
+        yield idx, res.get()
+    while pending:
+      idx, res = pending.popleft()
+      yield idx, res.get()
+  finally:
+    pool.terminate()
 
 
 if __name__ == "__main__":
@@ -60,17 +86,22 @@ if __name__ == "__main__":
     if ext == "png":
       name_parse = name.split("_")
       idx = int(name_parse[-1])
-      img = Image.open(path.join(args.frame_path, filename))
+      filename = path.join(args.frame_path, filename)
       if name_parse[-2] == "mv":
-        frames_mv.append((idx, img))
+        frames_mv.append((idx, filename))
       else:
-        frames.append((idx, img))
+        frames.append((idx, filename))
   if len(frames) == 0:
     print("No frames in directory: " + args.frame_path)
     sys.exit()
+  #sort the frames based on the frame index
+  frames.sort()
+  frames_mv.sort()
+  #only the size is read here, the frames are decoded while writing
+  width, height = Image.open(frames[0][1]).size
   print("----------------------Y4M Info----------------------")
-  print("width:  %d" % frames[0][1].width)
-  print("height: %d" % frames[0][1].height)
+  print("width:  %d" % width)
+  print("height: %d" % height)
   print("#frame: %d" % len(frames))
   print("frame rate: %s" % args.frame_rate)
   print("interlacing: %s" % args.interlacing)
@@ -79,7 +110,7 @@ if __name__ == "__main__":
   print("----------------------------------------------------")
 
   print("Generating ...")
-  generate(args, frames)
+  generate(args, decodeFrames(frames, args.workers))
   if len(frames_mv) != 0:
     args.output = args.output.replace(".y4m", "_mv.y4m")
-    generate(args, frames_mv)
+    generate(args, decodeFrames(frames_mv, args.workers))